@@ -0,0 +1,47 @@
+import os
+import threading
+
+import cv2
+
+from detections import as_detections
+from metrics import stages
+
+
+RENDER_MODE = "lazy"  # "lazy" - рисовать при первом GET, "eager" - сразу при загрузке, "none" - только JSON
+RENDER_MODES = ("lazy", "eager", "none")
+PROCESSED_QUALITY = 90
+# параметры кодирования по расширению обработанного файла (оно совпадает с расширением загрузки)
+ENCODE_PARAMS = {
+    '.jpg': [cv2.IMWRITE_JPEG_QUALITY, PROCESSED_QUALITY],
+    '.jpeg': [cv2.IMWRITE_JPEG_QUALITY, PROCESSED_QUALITY],
+    '.webp': [cv2.IMWRITE_WEBP_QUALITY, PROCESSED_QUALITY],
+}
+
+
+def draw_detections(image, detections, line_width=None):
+    # Рамки и подписи в том же виде, что и results[0].plot(), но по списку детекций
+    # (из ответа модели или из истории); исходное изображение не меняется
+    from ultralytics.utils.plotting import Annotator, colors
+
+    annotator = Annotator(image.copy(), line_width=line_width)
+    for box, label, confidence, class_id in as_detections(detections).rows():
+        annotator.box_label(box, f"{label} {confidence:.2f}", color=colors(class_id, True))
+    return annotator.result()
+
+
+def render_to_file(original_path, detections, processed_path):
+    # отрисовка по сохраненному оригиналу; запись через временный файл,
+    # чтобы параллельный GET не получил недописанное изображение
+    img = cv2.imread(original_path)
+    if img is None:
+        return False
+    with stages.timer('plot'):
+        annotated = draw_detections(img, detections)
+    extension = os.path.splitext(processed_path)[1]
+    tmp_path = f"{processed_path}.{os.getpid()}.{threading.get_ident()}{extension}"
+    with stages.timer('encode'):
+        # для png и bmp параметр качества JPEG OpenCV не принимает
+        if not cv2.imwrite(tmp_path, annotated, ENCODE_PARAMS.get(extension.lower(), [])):
+            return False
+    os.replace(tmp_path, processed_path)
+    return True
@@ -0,0 +1,310 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from detections import iou_matrix
+from metrics import summarize
+
+
+INFERENCE_BACKEND = "pytorch"  # "pytorch", "onnx" или "openvino"
+INT8 = False  # int8-квантизация экспортированной модели
+EXPORTS_PATH = "./models"  # кэш экспортированных моделей
+CALIBRATION_PATH = "./calibration"  # изображения для калибровки int8
+IMAGE_SIZE = 640
+FUSED_CACHE = True  # кэшировать модель со свернутыми слоями (pytorch)
+CALIBRATION_IMAGES = 300
+
+# допуски проверки совпадения детекций с исходной .pt моделью
+PARITY_IOU = 0.9
+PARITY_CONFIDENCE = 0.05
+
+BACKENDS = ("pytorch", "onnx", "openvino")
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def list_images(folder, limit=None):
+    images = sorted(str(p) for p in Path(folder).rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS)
+    return images[:limit] if limit else images
+
+
+def export_path(weights, backend, int8=False):
+    # путь к закэшированной модели зависит от содержимого весов,
+    # поэтому после переобучения экспорт выполнится заново
+    stem = f"{Path(weights).stem}_{file_hash(weights)}"
+    suffix = "_int8" if int8 else ""
+    if backend == "onnx":
+        return Path(EXPORTS_PATH) / f"{stem}{suffix}.onnx"
+    if backend == "openvino":
+        return Path(EXPORTS_PATH) / f"{stem}{suffix}_openvino_model"
+    raise ValueError(f"Неизвестный backend: {backend}")
+
+
+def fused_path(weights):
+    return Path(EXPORTS_PATH) / f"{Path(weights).stem}_{file_hash(weights)}_fused.pt"
+
+
+def save_fused(yolo, weights):
+    # Копия модели со свернутыми Conv+BN (после первого прогона predictor хранит ее у себя).
+    # ultralytics не сворачивает уже свернутую модель повторно
+    import torch
+    from copy import deepcopy
+
+    path = fused_path(weights)
+    if path.exists():
+        return None
+    fused = yolo.predictor.model.model
+    if not fused.is_fused():
+        return None
+    ckpt = dict(getattr(yolo, 'ckpt', None) or {})
+    ckpt.update(model=deepcopy(fused), ema=None, optimizer=None)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    torch.save(ckpt, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def resolve_weights(weights, backend=INFERENCE_BACKEND, int8=INT8, calibration_dir=CALIBRATION_PATH):
+    # путь к весам для выбранного backend (с экспортом при первом запуске)
+    if backend == "pytorch":
+        # свернутая копия из кэша, если она уже сохранена (см. save_fused)
+        fused = fused_path(weights)
+        return str(fused) if FUSED_CACHE and fused.exists() else str(weights)
+    path = export_path(weights, backend, int8)
+    if not path.exists():
+        export_model(weights, backend, int8, calibration_dir)
+    return str(path)
+
+
+def export_model(weights, backend, int8=False, calibration_dir=CALIBRATION_PATH, imgsz=IMAGE_SIZE):
+    from ultralytics import YOLO
+
+    target = export_path(weights, backend, int8)
+    os.makedirs(EXPORTS_PATH, exist_ok=True)
+    print(f"Экспорт модели {weights} в {backend}{' (int8)' if int8 else ''}...")
+
+    # экспортируем во временную папку, чтобы не мусорить рядом с весами
+    with tempfile.TemporaryDirectory() as tmp:
+        local_weights = Path(tmp) / Path(weights).name
+        shutil.copy(weights, local_weights)
+        model = YOLO(str(local_weights))
+
+        if backend == "onnx":
+            exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+            if int8:
+                quantized = Path(tmp) / "quantized.onnx"
+                _quantize_onnx(exported, quantized, calibration_dir, imgsz)
+                exported = quantized
+        elif backend == "openvino":
+            data = _calibration_yaml(tmp, calibration_dir, model.names) if int8 else None
+            exported = model.export(format="openvino", imgsz=imgsz, dynamic=True, int8=int8, data=data)
+        else:
+            raise ValueError(f"Неизвестный backend: {backend}")
+
+        if target.exists():
+            shutil.rmtree(target) if target.is_dir() else target.unlink()
+        shutil.move(str(exported), str(target))
+
+    print(f"Модель экспортирована: {target}")
+    return str(target)
+
+
+def _letterbox(img, imgsz=IMAGE_SIZE):
+    # та же подготовка кадра, что и у ultralytics: ресайз с сохранением пропорций + паддинг
+    h, w = img.shape[:2]
+    scale = min(imgsz / h, imgsz / w)
+    nh, nw = int(round(h * scale)), int(round(w * scale))
+    resized = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    canvas[top:top + nh, left:left + nw] = resized
+    blob = canvas[:, :, ::-1].transpose(2, 0, 1).astype(np.float32) / 255.0
+    return blob[None]
+
+
+def _quantize_onnx(fp32_path, int8_path, calibration_dir, imgsz):
+    # статическая post-training квантизация по папке калибровочных изображений
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+    images = list_images(calibration_dir, CALIBRATION_IMAGES)
+    if not images:
+        raise FileNotFoundError(f"Нет изображений для калибровки в {calibration_dir}")
+    input_name = onnx.load(str(fp32_path), load_external_data=False).graph.input[0].name
+
+    class FolderReader(CalibrationDataReader):
+        def __init__(self):
+            self._iter = iter(images)
+
+        def get_next(self):
+            for path in self._iter:
+                img = cv2.imread(path)
+                if img is not None:
+                    return {input_name: _letterbox(img, imgsz)}
+            return None
+
+    quantize_static(str(fp32_path), str(int8_path), FolderReader(),
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+    # метаданные (имена классов, imgsz) нужны ultralytics при загрузке
+    source, quantized = onnx.load(str(fp32_path)), onnx.load(str(int8_path))
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, str(int8_path))
+
+
+def _calibration_yaml(tmp, calibration_dir, names):
+    # ultralytics берет калибровочные данные для OpenVINO/NNCF из yaml датасета
+    import yaml
+
+    path = Path(tmp) / "calibration.yaml"
+    folder = str(Path(calibration_dir).resolve())
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump({'path': folder, 'train': folder, 'val': folder, 'names': dict(names)}, f)
+    return str(path)
+
+
+def _load(weights, backend, int8=False):
+    from ultralytics import YOLO
+
+    return YOLO(resolve_weights(weights, backend, int8), task='detect')
+
+
+def _boxes(result):
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0)
+    return boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy()
+
+
+def parity_check(weights, backend, images, int8=False, confidence_threshold=0.5,
+                 iou_tolerance=PARITY_IOU, confidence_tolerance=PARITY_CONFIDENCE):
+    # Сравнивает детекции экспортированной модели с исходной .pt:
+    # каждой рамке должна найтись пара того же класса с IoU >= iou_tolerance
+    # и разницей уверенности <= confidence_tolerance
+    reference = _load(weights, "pytorch")
+    candidate = _load(weights, backend, int8)
+
+    matched = missing = extra = 0
+    failed_images = []
+    for path in images:
+        ref_boxes, ref_conf, ref_cls = _boxes(reference(path, conf=confidence_threshold, device='cpu', verbose=False)[0])
+        cand_boxes, cand_conf, cand_cls = _boxes(candidate(path, conf=confidence_threshold, device='cpu', verbose=False)[0])
+
+        used = np.zeros(len(cand_boxes), dtype=bool)
+        image_missing = 0
+        for box, conf, cls in zip(ref_boxes, ref_conf, ref_cls):
+            ok = (~used) & (cand_cls == cls) & (np.abs(cand_conf - conf) <= confidence_tolerance)
+            ious = np.where(ok, iou_matrix(box, cand_boxes)[0], 0) if len(cand_boxes) else np.zeros(0)
+            if len(ious) and ious.max() >= iou_tolerance:
+                used[ious.argmax()] = True
+                matched += 1
+            else:
+                image_missing += 1
+        image_extra = int((~used).sum())
+        missing += image_missing
+        extra += image_extra
+        if image_missing or image_extra:
+            failed_images.append(path)
+
+    total = matched + missing
+    report = {
+        'backend': backend,
+        'int8': int8,
+        'images': len(images),
+        'matched': matched,
+        'missing': missing,
+        'extra': extra,
+        'match_rate': round(matched / total, 4) if total else 1.0,
+        'failed_images': failed_images,
+        'passed': not failed_images,
+    }
+    return report
+
+
+def benchmark(weights, images, backends=BACKENDS, int8=False, warmup=5, confidence_threshold=0.5):
+    # изображения в секунду и p50/p99 задержки для каждого backend
+    frames = [img for img in (cv2.imread(p) for p in images) if img is not None]
+    if not frames:
+        raise ValueError("Нет изображений для бенчмарка")
+
+    results = []
+    for backend in backends:
+        model = _load(weights, backend, int8 and backend != "pytorch")
+        for frame in frames[:warmup]:
+            model(frame, conf=confidence_threshold, device='cpu', verbose=False)
+
+        latencies = []
+        started = time.perf_counter()
+        for frame in frames:
+            t0 = time.perf_counter()
+            model(frame, conf=confidence_threshold, device='cpu', verbose=False)
+            latencies.append((time.perf_counter() - t0) * 1000)
+        elapsed = time.perf_counter() - started
+
+        summary = summarize(latencies)
+        results.append({
+            'backend': backend + ("-int8" if int8 and backend != "pytorch" else ""),
+            'images_per_sec': round(len(frames) / elapsed, 2),
+            'p50_ms': summary['p50'],
+            'p99_ms': summary['p99'],
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from model import MODEL_PATH
+
+    parser = argparse.ArgumentParser(description="Экспорт модели в ONNX/OpenVINO, проверка и бенчмарк")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_export = sub.add_parser('export', help="экспортировать модель в кэш")
+    p_export.add_argument('--backend', choices=BACKENDS[1:], required=True)
+
+    p_parity = sub.add_parser('parity', help="сравнить детекции с исходной .pt моделью")
+    p_parity.add_argument('--backend', choices=BACKENDS[1:], required=True)
+    p_parity.add_argument('--images', required=True)
+
+    p_bench = sub.add_parser('benchmark', help="сравнить скорость backend'ов")
+    p_bench.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    p_bench.add_argument('--images', required=True)
+
+    for p in (p_export, p_parity, p_bench):
+        p.add_argument('--weights', default=MODEL_PATH)
+        p.add_argument('--int8', action='store_true')
+        p.add_argument('--calibration', default=CALIBRATION_PATH)
+        p.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_model(args.weights, args.backend, args.int8, args.calibration)
+        raise SystemExit
+
+    # экспорт (если его еще нет в кэше) с калибровкой по указанной папке
+    for backend in ([args.backend] if args.command == 'parity' else args.backends):
+        resolve_weights(args.weights, backend, args.int8 and backend != "pytorch", args.calibration)
+
+    if args.command == 'parity':
+        report = parity_check(args.weights, args.backend, list_images(args.images, args.limit), args.int8)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        for row in benchmark(args.weights, list_images(args.images, args.limit), args.backends, args.int8):
+            print(f"{row['backend']:<14} {row['images_per_sec']:>8} img/s   "
+                  f"p50 {row['p50_ms']:>8} ms   p99 {row['p99_ms']:>8} ms")
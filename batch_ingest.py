@@ -0,0 +1,175 @@
+import hashlib
+import os
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from history_store import HISTORY_BACKEND, create_history_store
+from model import CONFIDENCE_THRESHOLD, MODEL_PATH, MuzzleDetectorModel
+from rollups import RollupStore
+from storage import SHARD_FORMAT, UPLOAD_FOLDER
+
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+INGEST_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+INGEST_CHUNK_SIZE = 16  # изображений в одной задаче (= батч модели)
+CHECKPOINTS_PATH = './checkpoints'
+
+# модель загружается один раз на рабочий процесс
+_worker_detector = None
+
+
+def list_entries(source):
+    # относительные имена изображений в папке или zip-архиве
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = [n for n in archive.namelist() if Path(n).suffix.lower() in IMAGE_EXTENSIONS]
+    else:
+        root = Path(source)
+        names = [p.relative_to(root).as_posix() for p in root.rglob('*')
+                 if p.suffix.lower() in IMAGE_EXTENSIONS]
+    return sorted(names)
+
+
+def checkpoint_path(source):
+    digest = hashlib.sha1(str(Path(source).resolve()).encode('utf-8')).hexdigest()[:12]
+    return Path(CHECKPOINTS_PATH) / f"ingest_{Path(source).stem}_{digest}.done"
+
+
+def load_checkpoint(path):
+    if not Path(path).exists():
+        return set()
+    with open(path, 'r', encoding='utf-8') as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def _init_worker(model_kwargs, threads):
+    global _worker_detector
+    import torch
+
+    # делим ядра между процессами, чтобы они не мешали друг другу
+    torch.set_num_threads(threads)
+    _worker_detector = MuzzleDetectorModel(history_backend=None, **model_kwargs)
+
+
+def _process_chunk(source, names, confidence_threshold, save_dir):
+    # декодирование и инференс пачки изображений в рабочем процессе
+    archive = zipfile.ZipFile(source) if zipfile.is_zipfile(source) else None
+    try:
+        frames = []
+        for name in names:
+            if archive is not None:
+                data = np.frombuffer(archive.read(name), np.uint8)
+                frames.append(cv2.imdecode(data, cv2.IMREAD_COLOR))
+            else:
+                frames.append(cv2.imread(str(Path(source) / name)))
+    finally:
+        if archive is not None:
+            archive.close()
+
+    results = []
+    # разметка рисуется, только если результаты сохраняются на диск
+    outputs = _worker_detector.predict_batch(frames, confidence_threshold, render=bool(save_dir))
+    for name, frame, (detections, processed_image) in zip(names, frames, outputs):
+        if frame is None:
+            results.append((name, None, None))
+            continue
+        processed_filename = None
+        if save_dir and processed_image is not None:
+            digest = hashlib.sha1(f"{source}|{name}".encode('utf-8')).hexdigest()[:8]
+            # в папку текущего часа, как и загрузки через веб-интерфейс
+            shard = datetime.now().strftime(SHARD_FORMAT)
+            os.makedirs(os.path.join(save_dir, shard), exist_ok=True)
+            processed_filename = f"{shard}/processed_batch_{digest}_{Path(name).name}"
+            cv2.imwrite(os.path.join(save_dir, processed_filename), processed_image)
+        results.append((name, detections, processed_filename))
+    return results
+
+
+def ingest(source, workers=INGEST_WORKERS, chunk_size=INGEST_CHUNK_SIZE,
+           confidence_threshold=CONFIDENCE_THRESHOLD, save_images=False, checkpoint=None,
+           history_backend=HISTORY_BACKEND, history_path=None, model_kwargs=None):
+    # Пакетная обработка папки или zip-архива.
+    # Прогресс пишется в checkpoint-файл после записи каждой пачки в историю,
+    # поэтому прерванный запуск продолжается с места остановки
+    checkpoint = Path(checkpoint or checkpoint_path(source))
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    done = load_checkpoint(checkpoint)
+    pending = [name for name in list_entries(source) if name not in done]
+    total = len(pending)
+    print(f"Изображений к обработке: {total} (уже обработано: {len(done)})")
+    if not total:
+        return {'processed': 0, 'failed': 0, 'skipped': len(done)}
+
+    save_dir = UPLOAD_FOLDER if save_images else None
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    history = create_history_store(history_backend, history_path)
+    rollups = RollupStore()
+    chunks = [pending[i:i + chunk_size] for i in range(0, total, chunk_size)]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    processed = failed = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                             initargs=(model_kwargs or {}, threads)) as pool, \
+            open(checkpoint, 'a', encoding='utf-8') as progress:
+        queue = iter(chunks)
+        in_flight = set()
+        # в работе не больше двух пачек на процесс - память не растет с размером архива
+        while True:
+            while len(in_flight) < workers * 2:
+                chunk = next(queue, None)
+                if chunk is None:
+                    break
+                in_flight.add(pool.submit(_process_chunk, str(source), chunk, confidence_threshold, save_dir))
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results = future.result()
+                records = [MuzzleDetectorModel.make_record(Path(name).name, detections, processed_filename,
+                                                           source=str(source), path=name)
+                           for name, detections, processed_filename in results if detections is not None]
+                # одна транзакция на пачку
+                history.append_many(records)
+                rollups.update(records)
+                progress.write(''.join(name + '\n' for name, _, _ in results))
+                progress.flush()
+
+                processed += len(records)
+                failed += len(results) - len(records)
+
+            elapsed = time.perf_counter() - started
+            rate = (processed + failed) / elapsed if elapsed else 0.0
+            eta = (total - processed - failed) / rate if rate else 0.0
+            print(f"{processed + failed}/{total}  {rate:.1f} img/s  ETA {eta:.0f} с")
+
+    elapsed = time.perf_counter() - started
+    print(f"Готово: {processed} изображений, ошибок чтения: {failed}, {elapsed:.1f} с")
+    return {'processed': processed, 'failed': failed, 'skipped': len(done),
+            'elapsed_sec': round(elapsed, 2), 'images_per_sec': round((processed + failed) / elapsed, 2)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Пакетная обработка папки или zip-архива с изображениями")
+    parser.add_argument('source', help="папка или zip-архив")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=INGEST_CHUNK_SIZE)
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE_THRESHOLD)
+    parser.add_argument('--save-images', action='store_true', help="сохранять размеченные изображения")
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--weights', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    ingest(args.source, args.workers, args.chunk_size, args.confidence, args.save_images,
+           args.checkpoint, model_kwargs={'model_path': args.weights})
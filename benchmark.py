@@ -0,0 +1,182 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from itertools import cycle
+
+from metrics import rss_bytes, stages, summarize
+
+
+BENCH_LEVELS = (1, 2, 4, 8, 16)  # число одновременных клиентов
+BENCH_REQUESTS = 64  # запросов на каждый уровень
+REQUEST_TIMEOUT = 120
+
+
+def _run_level(call, payloads, concurrency, requests):
+    # requests вызовов call(payload) из concurrency потоков
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    source = cycle(payloads)
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+                payload = next(source)
+            t0 = time.perf_counter()
+            try:
+                call(payload)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': summarize(latencies),
+    }
+
+
+def _read_images(images):
+    payloads = []
+    for path in images:
+        with open(path, 'rb') as f:
+            payloads.append((os.path.basename(path), f.read()))
+    if not payloads:
+        raise ValueError("Нет изображений для бенчмарка")
+    return payloads
+
+
+def run_api(images, levels=BENCH_LEVELS, requests=BENCH_REQUESTS, use_queue=True, render=False, model_kwargs=None):
+    # Путь запроса без HTTP: decode -> predict (через очередь микробатчинга) -> запись в историю.
+    # История пишется во временную папку, рабочая история не меняется
+    import cv2
+    import numpy as np
+
+    from inference_queue import BatchInferenceQueue
+    from model import MuzzleDetectorModel
+
+    payloads = _read_images(images)
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    detector = MuzzleDetectorModel(history_file=os.path.join(workdir, 'history.json'),
+                                   history_path=os.path.join(workdir, 'history.db'),
+                                   rollups_path=os.path.join(workdir, 'rollups.db'), **(model_kwargs or {}))
+    queue = BatchInferenceQueue(detector) if use_queue else None
+
+    def call(payload):
+        name, data = payload
+        with stages.timer('decode'):
+            frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if queue is not None:
+            detections, _ = queue.predict(frame, render=render)
+        else:
+            detections, _ = detector.predict(frame, render=render)
+        detector.save_to_history(name, detections, None)
+
+    call(payloads[0])  # прогрев
+    rows = []
+    for level in levels:
+        stages.reset()
+        row = _run_level(call, payloads, level, requests)
+        row['rss_bytes'] = rss_bytes()
+        row['stages'] = stages.summary()
+        rows.append(row)
+    if queue is not None:
+        queue.shutdown()
+    return rows
+
+
+def _server_rss(metrics_url):
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=10) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith('muzzle_process_resident_memory_bytes '):
+                    return int(float(line.split()[1]))
+    except OSError:
+        pass
+    return None
+
+
+def run_http(url, images, levels=BENCH_LEVELS, requests=BENCH_REQUESTS, cache_bust=True):
+    # Нагрузка на запущенный сервер: POST /upload, RSS сервера берется из /metrics
+    import urllib.request
+
+    payloads = _read_images(images)
+    base = url.rstrip('/')
+    if base.endswith('/upload'):
+        base = base[:-len('/upload')]
+
+    def call(payload):
+        name, data = payload
+        boundary = uuid.uuid4().hex
+        if cache_bust:
+            # уникальный хвост, чтобы не попадать в кэш результатов
+            data += boundary.encode()
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+                f"filename=\"bench_{boundary[:8]}_{name}\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+        body += data + f"\r\n--{boundary}--\r\n".encode()
+        request = urllib.request.Request(f"{base}/upload", data=body, method='POST',
+                                         headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            response.read()
+
+    rows = []
+    for level in levels:
+        row = _run_level(call, payloads, level, requests)
+        row['rss_bytes'] = _server_rss(f"{base}/metrics")
+        rows.append(row)
+    return rows
+
+
+def print_rows(rows):
+    for row in rows:
+        latency = row['latency_ms']
+        rss = f"{row['rss_bytes'] / 1024 ** 2:.0f} МБ" if row.get('rss_bytes') else "-"
+        print(f"клиентов {row['concurrency']:>3}: {row['throughput']:7.2f} запр/с   "
+              f"p50 {latency.get('p50', 0):8.1f}   p95 {latency.get('p95', 0):8.1f}   "
+              f"p99 {latency.get('p99', 0):8.1f} мс   RSS {rss}   ошибок {row['errors']}")
+        if row.get('stages'):
+            print("    " + "   ".join(f"{stage} {s['mean_ms']:.2f} мс" for stage, s in sorted(row['stages'].items())))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from backends import list_images
+
+    parser = argparse.ArgumentParser(description="Бенчмарк детектора: пропускная способность, p50/p95/p99, RSS")
+    parser.add_argument('mode', choices=['api', 'http'])
+    parser.add_argument('--images', required=True, help="папка с изображениями для прогона")
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--levels', type=int, nargs='+', default=list(BENCH_LEVELS))
+    parser.add_argument('--requests', type=int, default=BENCH_REQUESTS)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="адрес сервера (режим http)")
+    parser.add_argument('--no-queue', action='store_true', help="вызывать predict напрямую, без микробатчинга (api)")
+    parser.add_argument('--render', action='store_true', help="рисовать разметку (api)")
+    parser.add_argument('--cache', action='store_true', help="не обходить кэш результатов (http)")
+    args = parser.parse_args()
+
+    images = list_images(args.images, args.limit)
+    if args.mode == 'api':
+        print_rows(run_api(images, args.levels, args.requests, not args.no_queue, args.render))
+    else:
+        print_rows(run_http(args.url, images, args.levels, args.requests, not args.cache))
@@ -0,0 +1,34 @@
+import os
+import sqlite3
+import threading
+
+
+SQLITE_TIMEOUT = 30.0  # сколько ждать блокировки базы другим процессом, секунды
+
+
+class LocalConnection:
+    # Соединение SQLite для хранилищ (история, агрегаты, кэш, задачи): отдельное на каждый поток
+    # и заново после fork() - соединения родителя в дочернем процессе использовать нельзя.
+    # WAL: читатели не ждут писателя, в том числе из других рабочих процессов
+
+    def __init__(self, path, timeout=SQLITE_TIMEOUT):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        # соединение текущего потока
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,137 @@
+import numpy as np
+
+
+LABELS = ('with_muzzle', 'without_muzzle')  # id метки в сжатой записи = индекс (совпадает с классами модели)
+BOX_DECIMALS = 1  # знаков после запятой у координат рамок в истории
+CONFIDENCE_DECIMALS = 4
+DETECTION_KEYS = {'bbox', 'label', 'confidence', 'class_id'}
+
+
+class Detections:
+    # Детекции кадра столбцами: boxes (N, 4) x1 y1 x2 y2, confidences (N,), class_ids (N,).
+    # Список словарей (формат API) строится только на выходе - to_list()
+
+    __slots__ = ('boxes', 'confidences', 'class_ids', 'names', 'model_version')
+
+    def __init__(self, boxes=(), confidences=(), class_ids=(), names=None, model_version=None):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.confidences = np.asarray(confidences, dtype=np.float64).reshape(-1)
+        self.class_ids = np.asarray(class_ids, dtype=np.int64).reshape(-1)
+        self.names = dict(enumerate(LABELS)) if names is None else names
+        self.model_version = model_version  # версия модели, которая дала детекции
+
+    @classmethod
+    def from_result(cls, result, names, model_version=None):
+        boxes = result.boxes
+        if boxes is None or not len(boxes):
+            return cls(names=names, model_version=model_version)
+        return cls(boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy(), names,
+                   model_version)
+
+    @classmethod
+    def from_list(cls, detections):
+        names = dict(enumerate(LABELS))
+        class_ids = []
+        for d in detections:
+            class_id = d.get('class_id')
+            if class_id is None:
+                # в старых записях истории class_id может не быть
+                class_id = LABELS.index(d['label']) if d['label'] in LABELS else len(LABELS)
+            names[class_id] = d['label']
+            class_ids.append(class_id)
+        return cls([d['bbox'] for d in detections], [d['confidence'] for d in detections], class_ids, names)
+
+    @classmethod
+    def decode(cls, data):
+        # из сжатой записи истории: {"b": координаты подряд, "c": уверенности, "k": id меток}
+        ids = data.get('k', [])
+        labels = [LABELS[k] if isinstance(k, int) else k for k in ids]
+        class_ids = data.get('i', ids)
+        return cls(data.get('b', []), data.get('c', []), class_ids, dict(zip(class_ids, labels)))
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def label(self, class_id):
+        return self.names.get(class_id, f"class_{class_id}")
+
+    def labels(self):
+        return [self.label(class_id) for class_id in self.class_ids.tolist()]
+
+    def counts(self):
+        # число рамок по меткам, одним проходом по class_ids
+        counts = np.bincount(self.class_ids, minlength=len(self.names)) if len(self) else ()
+        return {self.label(class_id): int(count) for class_id, count in enumerate(counts) if count}
+
+    def stats(self):
+        counts = self.counts()
+        return {
+            "total_dogs": len(self),
+            "with_muzzle": counts.get("with_muzzle", 0),
+            "without_muzzle": counts.get("without_muzzle", 0),
+        }
+
+    def max_confidence(self):
+        return float(self.confidences.max()) if len(self) else 0.0
+
+    def rows(self):
+        # (bbox, метка, уверенность, class_id) по рамкам
+        return zip(self.boxes.tolist(), self.labels(), self.confidences.tolist(), self.class_ids.tolist())
+
+    def to_list(self):
+        return [{"bbox": box, "label": label, "confidence": confidence, "class_id": class_id}
+                for box, label, confidence, class_id in self.rows()]
+
+    def encode(self):
+        # округленные координаты и уверенности, метки - индексами в LABELS
+        # (class_id отдельно - только если не совпадает с индексом метки)
+        labels = self.labels()
+        ids = [LABELS.index(label) if label in LABELS else label for label in labels]
+        data = {
+            'b': np.round(self.boxes, BOX_DECIMALS).ravel().tolist(),
+            'c': np.round(self.confidences, CONFIDENCE_DECIMALS).tolist(),
+            'k': ids,
+        }
+        class_ids = self.class_ids.tolist()
+        if class_ids != ids:
+            data['i'] = class_ids
+        return data
+
+
+def iou_matrix(a, b):
+    # попарный IoU между рамками a (N, 4) и b (M, 4) в формате xyxy
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def as_detections(value):
+    # Detections из результата модели, сжатой записи или списка словарей
+    if isinstance(value, Detections):
+        return value
+    if isinstance(value, dict):
+        return Detections.decode(value)
+    return Detections.from_list(value or [])
+
+
+def encode_detections(value):
+    # для истории и кэша; список с дополнительными полями (например track_id видео) хранится как есть
+    if isinstance(value, list) and any(set(d) != DETECTION_KEYS for d in value):
+        return value
+    return as_detections(value).encode()
+
+
+def decode_detections(value):
+    # формат API: список словарей
+    if isinstance(value, dict):
+        return Detections.decode(value).to_list()
+    if isinstance(value, Detections):
+        return value.to_list()
+    return value
@@ -0,0 +1,553 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from db import LocalConnection
+from detections import as_detections, decode_detections, encode_detections
+
+
+HISTORY_BACKEND = "sqlite"  # "sqlite" или "jsonl"
+HISTORY_DB = "history.db"
+HISTORY_JOURNAL = "history.jsonl"
+LEGACY_HISTORY_FILE = "history.json"
+TOTALS_FIELDS = ("records", "total_dogs", "with_muzzle", "without_muzzle")
+PAGE_SIZE = 50
+RANGE_BATCH_SIZE = 5000  # записей за один запрос при обходе range()
+
+
+def record_labels(record):
+    return sorted(set(as_detections(record.get('detections')).labels()))
+
+
+def record_max_confidence(record):
+    return as_detections(record.get('detections')).max_confidence()
+
+
+def encode_record(record):
+    # компактная строка: детекции столбцами с округлением (см. Detections.encode), без отступов
+    if 'detections' in record:
+        record = {**record, 'detections': encode_detections(record['detections'])}
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_record(data):
+    record = json.loads(data)
+    if 'detections' in record:
+        record['detections'] = decode_detections(record['detections'])
+    return record
+
+
+def record_matches(record, label=None, min_confidence=None, has_without_muzzle=None):
+    # фильтры страницы истории (та же логика, что и в SQL-запросе SqliteHistoryStore.page)
+    if label is not None and label not in record_labels(record):
+        return False
+    if min_confidence is not None and record_max_confidence(record) < min_confidence:
+        return False
+    if has_without_muzzle is not None and (record.get('stats', {}).get('without_muzzle', 0) > 0) != has_without_muzzle:
+        return False
+    return True
+
+
+class HistoryStore:
+    # Базовый интерфейс хранилища истории.
+    # Записи всегда возвращаются в хронологическом порядке (старые -> новые)
+
+    def append(self, record):
+        self.append_many([record])
+        return record
+
+    def append_many(self, records):
+        raise NotImplementedError
+
+    def tail(self, limit=50):
+        raise NotImplementedError
+
+    def range(self, start=None, end=None, limit=None):
+        # генератор записей с start <= timestamp < end (ISO-строки);
+        # история читается пачками, а не целиком
+        raise NotImplementedError
+
+    def page(self, before=None, after=None, limit=PAGE_SIZE, label=None, min_confidence=None,
+             has_without_muzzle=None):
+        # Страница истории от новых к старым.
+        # before - записи старше курсора, after - ближайшие к курсору записи новее него
+        raise NotImplementedError
+
+    def version(self):
+        # меняется при любом изменении истории (для ETag)
+        raise NotImplementedError
+
+    def find(self, processed_image):
+        # последняя запись с данным обработанным изображением
+        raise NotImplementedError
+
+    def expire_files(self, before):
+        # файлы записей старше before удалены при очистке загрузок
+        raise NotImplementedError
+
+    def files_expired_before(self):
+        return None
+
+    def _strip_expired(self, records):
+        # у записей с удаленными файлами ссылки на изображения обнуляются при чтении
+        expired = self.files_expired_before()
+        if expired:
+            for record in records:
+                if record['timestamp'] < expired:
+                    record['original_image'] = record['processed_image'] = None
+        return records
+
+    def count(self):
+        raise NotImplementedError
+
+    def totals(self):
+        # накопленные итоги по всей истории без ее перечитывания
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteHistoryStore(HistoryStore):
+    # Встроенная SQLite-база с индексом по времени.
+    # WAL-журнал позволяет читать параллельно с записью,
+    # а BEGIN IMMEDIATE сериализует писателей (в т.ч. из разных процессов)
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            filename TEXT,
+            processed_image TEXT,
+            total_dogs INTEGER NOT NULL DEFAULT 0,
+            with_muzzle INTEGER NOT NULL DEFAULT 0,
+            without_muzzle INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL,
+            labels TEXT NOT NULL DEFAULT '',
+            max_confidence REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_history_processed ON history(processed_image);
+        CREATE TABLE IF NOT EXISTS totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            records INTEGER NOT NULL,
+            total_dogs INTEGER NOT NULL,
+            with_muzzle INTEGER NOT NULL,
+            without_muzzle INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO totals
+            SELECT 1, COUNT(*), COALESCE(SUM(total_dogs), 0),
+                   COALESCE(SUM(with_muzzle), 0), COALESCE(SUM(without_muzzle), 0)
+            FROM history;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=HISTORY_DB, timeout=30.0):
+        self.path = str(path)
+        self.timeout = timeout
+        self._db = LocalConnection(self.path, timeout)
+        conn = self._db.get()
+        conn.executescript(self.SCHEMA)
+        self._migrate(conn)
+
+
+    @staticmethod
+    def _migrate(conn):
+        # колонки для фильтров истории в базах, созданных до их появления
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        if 'labels' in columns and 'max_confidence' in columns:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+            if 'labels' not in columns:
+                conn.execute("ALTER TABLE history ADD COLUMN labels TEXT NOT NULL DEFAULT ''")
+            if 'max_confidence' not in columns:
+                conn.execute("ALTER TABLE history ADD COLUMN max_confidence REAL NOT NULL DEFAULT 0")
+            updates = []
+            for row_id, data in conn.execute("SELECT id, data FROM history"):
+                record = json.loads(data)
+                updates.append((SqliteHistoryStore._labels(record), record_max_confidence(record), row_id))
+            conn.executemany("UPDATE history SET labels = ?, max_confidence = ? WHERE id = ?", updates)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _labels(record):
+        # ",with_muzzle,without_muzzle," - поиск метки через instr() без ложных совпадений
+        labels = record_labels(record)
+        return f",{','.join(labels)}," if labels else ''
+
+    @staticmethod
+    def _row(record):
+        stats = record.get('stats', {})
+        return (
+            record['timestamp'],
+            record.get('filename'),
+            record.get('processed_image'),
+            stats.get('total_dogs', 0),
+            stats.get('with_muzzle', 0),
+            stats.get('without_muzzle', 0),
+            encode_record(record),
+            SqliteHistoryStore._labels(record),
+            record_max_confidence(record),
+        )
+
+    def append_many(self, records):
+        rows = [self._row(r) for r in records]
+        if not rows:
+            return
+        conn = self._db.get()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO history (timestamp, filename, processed_image, "
+                "total_dogs, with_muzzle, without_muzzle, data, labels, max_confidence) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+            # итоги обновляются в той же транзакции
+            conn.execute(
+                "UPDATE totals SET records = records + ?, total_dogs = total_dogs + ?, "
+                "with_muzzle = with_muzzle + ?, without_muzzle = without_muzzle + ? WHERE id = 1",
+                (len(rows), sum(r[3] for r in rows), sum(r[4] for r in rows), sum(r[5] for r in rows)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def tail(self, limit=50):
+        rows = self._db.get().execute(
+            "SELECT data FROM history ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return self._strip_expired([decode_record(row[0]) for row in reversed(rows)])
+
+    def range(self, start=None, end=None, limit=None):
+        # постранично по (timestamp, id): курсор не держится открытым между пачками
+        last = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            query = "SELECT timestamp, id, data FROM history WHERE 1=1"
+            params = []
+            if start is not None:
+                query += " AND timestamp >= ?"
+                params.append(start)
+            if end is not None:
+                query += " AND timestamp < ?"
+                params.append(end)
+            if last is not None:
+                query += " AND (timestamp > ? OR (timestamp = ? AND id > ?))"
+                params.extend([last[0], last[0], last[1]])
+            batch = RANGE_BATCH_SIZE if remaining is None else min(RANGE_BATCH_SIZE, remaining)
+            query += " ORDER BY timestamp, id LIMIT ?"
+            params.append(batch)
+            rows = self._db.get().execute(query, params).fetchall()
+            if not rows:
+                return
+            last = rows[-1][:2]
+            if remaining is not None:
+                remaining -= len(rows)
+            yield from self._strip_expired([decode_record(row[2]) for row in rows])
+            if len(rows) < batch:
+                return
+
+    def page(self, before=None, after=None, limit=PAGE_SIZE, label=None, min_confidence=None,
+             has_without_muzzle=None):
+        query = "SELECT data FROM history WHERE 1=1"
+        params = []
+        if before is not None:
+            query += " AND timestamp < ?"
+            params.append(before)
+        if after is not None:
+            query += " AND timestamp > ?"
+            params.append(after)
+        if label is not None:
+            query += " AND instr(labels, ?) > 0"
+            params.append(f",{label},")
+        if min_confidence is not None:
+            query += " AND max_confidence >= ?"
+            params.append(min_confidence)
+        if has_without_muzzle is not None:
+            query += " AND without_muzzle > 0" if has_without_muzzle else " AND without_muzzle = 0"
+        # идем по индексу времени от курсора и останавливаемся на limit записях
+        ascending = after is not None and before is None
+        order = "ASC" if ascending else "DESC"
+        query += f" ORDER BY timestamp {order}, id {order} LIMIT ?"
+        params.append(limit)
+        records = [decode_record(row[0]) for row in self._db.get().execute(query, params)]
+        if ascending:
+            records.reverse()
+        return self._strip_expired(records)
+
+    def find(self, processed_image):
+        row = self._db.get().execute(
+            "SELECT data FROM history WHERE processed_image = ? ORDER BY id DESC LIMIT 1",
+            (processed_image,)).fetchone()
+        return self._strip_expired([decode_record(row[0])])[0] if row else None
+
+    def version(self):
+        # последний выданный id (не переиспользуется благодаря AUTOINCREMENT) + число записей,
+        # которое меняется при очистке
+        conn = self._db.get()
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+        records = conn.execute("SELECT records FROM totals WHERE id = 1").fetchone()[0]
+        return f"{row[0] if row else 0}-{records}-{self.files_expired_before()}"
+
+    def expire_files(self, before):
+        # граница только растет
+        self._db.get().execute(
+            "INSERT INTO meta (key, value) VALUES ('files_expired_before', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)", (before,))
+
+    def files_expired_before(self):
+        row = self._db.get().execute("SELECT value FROM meta WHERE key = 'files_expired_before'").fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        return self._db.get().execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def totals(self):
+        row = self._db.get().execute(
+            "SELECT records, total_dogs, with_muzzle, without_muzzle FROM totals WHERE id = 1").fetchone()
+        return dict(zip(TOTALS_FIELDS, row))
+
+    def clear(self):
+        conn = self._db.get()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM history")
+        conn.execute("UPDATE totals SET records = 0, total_dogs = 0, with_muzzle = 0, without_muzzle = 0")
+        conn.execute("COMMIT")
+
+    def close(self):
+        self._db.close()
+
+
+class JsonlHistoryStore(HistoryStore):
+    # Журнал "только на дозапись": одна JSON-запись на строку.
+    # Пачка записей уходит одним write() в файл, открытый с O_APPEND,
+    # поэтому параллельные писатели не затирают друг друга
+
+    READ_BLOCK = 64 * 1024
+
+    def __init__(self, path=HISTORY_JOURNAL):
+        self.path = str(path)
+        self.totals_path = f"{self.path}.totals"
+        self.expired_path = f"{self.path}.expired"
+        self._lock = threading.Lock()
+        Path(self.path).touch(exist_ok=True)
+        self._offset, self._totals = self._load_totals()
+
+    def append_many(self, records):
+        if not records:
+            return
+        data = ''.join(encode_record(r) + '\n' for r in records).encode('utf-8')
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def _iter_lines_reversed(self):
+        # читаем файл блоками с конца, не загружая его целиком
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                size = min(self.READ_BLOCK, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if remainder.strip():
+                yield remainder
+
+    def _iter_records(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield decode_record(line)
+
+    def tail(self, limit=50):
+        records = []
+        for line in self._iter_lines_reversed():
+            if len(records) >= limit:
+                break
+            records.append(decode_record(line))
+        records.reverse()
+        return self._strip_expired(records)
+
+    def range(self, start=None, end=None, limit=None):
+        batch = []
+        count = 0
+        for record in self._iter_records():
+            ts = record['timestamp']
+            if start is not None and ts < start:
+                continue
+            if end is not None and ts >= end:
+                continue
+            batch.append(record)
+            count += 1
+            if limit is not None and count >= limit:
+                break
+            if len(batch) >= RANGE_BATCH_SIZE:
+                yield from self._strip_expired(batch)
+                batch = []
+        yield from self._strip_expired(batch)
+
+    def page(self, before=None, after=None, limit=PAGE_SIZE, label=None, min_confidence=None,
+             has_without_muzzle=None):
+        # журнал читается с конца, пока не наберется страница
+        records = []
+        for line in self._iter_lines_reversed():
+            record = decode_record(line)
+            ts = record['timestamp']
+            if before is not None and ts >= before:
+                continue
+            if after is not None and ts <= after:
+                break
+            if not record_matches(record, label, min_confidence, has_without_muzzle):
+                continue
+            records.append(record)
+            if after is None or before is not None:
+                if len(records) >= limit:
+                    break
+            elif len(records) > limit:
+                # для after нужны самые близкие к курсору записи - держим только последние
+                records.pop(0)
+        return self._strip_expired(records)
+
+    def find(self, processed_image):
+        # без индекса: поиск с конца журнала (свежие записи находятся быстро)
+        for line in self._iter_lines_reversed():
+            record = decode_record(line)
+            if record.get('processed_image') == processed_image:
+                return self._strip_expired([record])[0]
+        return None
+
+    def version(self):
+        stat = os.stat(self.path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}-{self.files_expired_before()}"
+
+    def expire_files(self, before):
+        # граница хранится рядом с журналом, сам журнал не переписывается
+        current = self.files_expired_before()
+        if current is not None and current >= before:
+            return
+        tmp = f"{self.expired_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(before)
+        os.replace(tmp, self.expired_path)
+
+    def files_expired_before(self):
+        try:
+            with open(self.expired_path, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def count(self):
+        return self.totals()['records']
+
+    def _load_totals(self):
+        # итоги хранятся рядом с журналом вместе со смещением, до которого они посчитаны
+        try:
+            with open(self.totals_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['offset'] <= os.path.getsize(self.path):
+                return saved['offset'], saved['totals']
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, dict.fromkeys(TOTALS_FIELDS, 0)
+
+    def totals(self):
+        # досчитываем только записи, дописанные после прошлого вызова
+        # (в том числе другими процессами)
+        with self._lock:
+            if self._offset > os.path.getsize(self.path):
+                # журнал очищен другим процессом
+                self._offset, self._totals = 0, dict.fromkeys(TOTALS_FIELDS, 0)
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                changed = False
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # строка еще дописывается
+                    self._offset += len(line)
+                    if not line.strip():
+                        continue
+                    stats = json.loads(line).get('stats', {})
+                    self._totals['records'] += 1
+                    for key in TOTALS_FIELDS[1:]:
+                        self._totals[key] += stats.get(key, 0)
+                    changed = True
+            if changed:
+                tmp = f"{self.totals_path}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'offset': self._offset, 'totals': self._totals}, f)
+                os.replace(tmp, self.totals_path)
+            return dict(self._totals)
+
+    def clear(self):
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+            self._offset, self._totals = 0, dict.fromkeys(TOTALS_FIELDS, 0)
+            if os.path.exists(self.totals_path):
+                os.unlink(self.totals_path)
+
+
+def create_history_store(backend=HISTORY_BACKEND, path=None):
+    # фабрика хранилищ истории
+    if backend == "sqlite":
+        return SqliteHistoryStore(path or HISTORY_DB)
+    if backend == "jsonl":
+        return JsonlHistoryStore(path or HISTORY_JOURNAL)
+    raise ValueError(f"Неизвестный тип хранилища истории: {backend}")
+
+
+def migrate_legacy_history(store, json_path=LEGACY_HISTORY_FILE):
+    # Одноразовый перенос записей из старого history.json.
+    # После переноса файл переименовывается, чтобы не импортировать его повторно
+    if not Path(json_path).exists():
+        return 0
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+    except Exception as e:
+        print(f"Не удалось прочитать {json_path}: {e}")
+        return 0
+
+    if not history:
+        return 0
+    if store.count() > 0:
+        print(f"Хранилище истории не пустое, перенос из {json_path} пропущен")
+        return 0
+
+    store.append_many(history)
+    os.replace(json_path, f"{json_path}.migrated")
+    print(f"Перенесено записей из {json_path}: {len(history)}")
+    return len(history)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Перенос истории из history.json в новое хранилище")
+    parser.add_argument('--backend', default=HISTORY_BACKEND, choices=['sqlite', 'jsonl'])
+    parser.add_argument('--path', default=None)
+    parser.add_argument('--source', default=LEGACY_HISTORY_FILE)
+    args = parser.parse_args()
+
+    migrate_legacy_history(create_history_store(args.backend, args.path), args.source)
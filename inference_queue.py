@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+
+from metrics import stages, summarize
+from model import CONFIDENCE_THRESHOLD
+
+
+MAX_BATCH_SIZE = 8  # максимум кадров в одном прогоне модели
+MAX_WAIT_MS = 10  # сколько ждать добора батча после первого кадра
+LATENCY_WINDOW = 1000  # сколько последних замеров хранить для перцентилей
+
+
+class LatencyStats:
+    # скользящее окно замеров задержки (в миллисекундах)
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._count = 0
+
+    def add(self, value_ms):
+        self._samples.append(value_ms)
+        self._count += 1
+
+    def summary(self):
+        summary = summarize(self._samples)
+        if summary['count']:
+            summary['count'] = self._count
+        return summary
+
+
+class _Request:
+    __slots__ = ('frame', 'confidence_threshold', 'render', 'future', 'enqueued_at')
+
+    def __init__(self, frame, confidence_threshold, render):
+        self.frame = frame
+        self.confidence_threshold = confidence_threshold
+        self.render = render
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchInferenceQueue:
+    # Очередь динамического микробатчинга перед MuzzleDetectorModel.
+    # Запросы кладут декодированные кадры в очередь, а фоновый поток
+    # собирает их в батчи (не больше max_batch_size и не дольше max_wait_ms)
+    # и прогоняет модель один раз на весь батч
+
+    _STOP = object()
+
+    def __init__(self, detector, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        # статистика
+        self._batch_sizes = Counter()
+        self._latency = defaultdict(LatencyStats)
+
+    def _ensure_worker(self):
+        # поток запускается лениво и перезапускается после fork()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='inference-queue', daemon=True)
+                self._thread.start()
+
+    def submit(self, frame, confidence_threshold=CONFIDENCE_THRESHOLD, render=True):
+        # возвращает Future с результатом (detections, processed_image)
+        # render=False - без отрисовки разметки (processed_image = None)
+        request = _Request(frame, confidence_threshold, render)
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, frame, confidence_threshold=CONFIDENCE_THRESHOLD, render=True, timeout=None):
+        return self.submit(frame, confidence_threshold, render).result(timeout)
+
+    def _collect(self):
+        # ждем первый кадр, затем добираем батч до лимита или дедлайна
+        first = self._queue.get()
+        if first is self._STOP:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                self._queue.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+
+            # запросы с разными порогами (и с отрисовкой / без) прогоняются отдельными группами
+            groups = defaultdict(list)
+            for request in batch:
+                groups[(request.confidence_threshold, request.render)].append(request)
+
+            for (confidence_threshold, render), requests in groups.items():
+                started = time.perf_counter()
+                try:
+                    outputs = self.detector.predict_batch([r.frame for r in requests], confidence_threshold, render)
+                except Exception as e:
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                finished = time.perf_counter()
+
+                with self._lock:
+                    self._batch_sizes[len(requests)] += 1
+                    self._latency['inference'].add((finished - started) * 1000)
+                    for request in requests:
+                        self._latency['queue_wait'].add((started - request.enqueued_at) * 1000)
+                        stages.observe('queue_wait', started - request.enqueued_at)
+                        self._latency['total'].add((finished - request.enqueued_at) * 1000)
+
+                for request, output in zip(requests, outputs):
+                    request.future.set_result(output)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': sum(self._batch_sizes.values()),
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'latency_ms': {stage: stats.summary() for stage, stats in self._latency.items()},
+            }
+
+    def shutdown(self, wait=True):
+        # уже поставленные в очередь кадры будут обработаны до остановки
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        if wait:
+            self._thread.join()
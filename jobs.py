@@ -0,0 +1,257 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from db import LocalConnection
+
+
+MAX_JOBS_KEPT = 1000  # сколько завершенных задач хранить для опроса статуса
+JOBS_DB = "jobs.db"
+JOBS_KEEP_SECONDS = 24 * 3600  # сколько хранить статусы задач в jobs.db
+EVICT_CHECK_EVERY = 100  # как часто удалять устаревшие статусы
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    # Статусы и результаты задач в SQLite: при нескольких рабочих процессах (serve.py)
+    # опрос статуса может попасть не в тот процесс, который выполняет задачу
+
+    def __init__(self, path=JOBS_DB, keep_seconds=JOBS_KEEP_SECONDS):
+        self.path = str(path)
+        self.keep_seconds = keep_seconds
+        self._db = LocalConnection(self.path)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db.get().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                manager TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs(updated_at);
+        """)
+
+
+    def put(self, manager, job):
+        # результат хранится только у завершенных задач и должен сериализоваться в JSON
+        data = job.to_dict()
+        if job.status == 'done':
+            data['result'] = job.result
+        with self._lock:
+            self._puts += 1
+            check = self._puts % EVICT_CHECK_EVERY == 0
+        conn = self._db.get()
+        conn.execute("INSERT OR REPLACE INTO jobs (job_id, manager, data, updated_at) VALUES (?, ?, ?, ?)",
+                     (job.id, manager, json.dumps(data, ensure_ascii=False, default=str), time.time()))
+        if check:
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - self.keep_seconds,))
+
+    def get(self, manager, job_id):
+        row = self._db.get().execute("SELECT data FROM jobs WHERE job_id = ? AND manager = ?",
+                                      (job_id, manager)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def delete(self, job_id):
+        self._db.get().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+
+class Job:
+
+    def __init__(self, fn, args, kwargs, kind=None, on_change=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        # монотонные отметки для времени ожидания в очереди и выполнения
+        self._queued = time.perf_counter()
+        self._started = None
+        self._finished = None
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._on_change = on_change
+        self._done = threading.Event()
+
+    def _changed(self):
+        if self._on_change is not None:
+            try:
+                self._on_change(self)
+            except Exception as e:
+                print(f"Не удалось сохранить статус задачи {self.kind} {self.id}: {e}")
+
+    def run(self):
+        self.status = 'running'
+        self.started_at = datetime.now().isoformat()
+        self._started = time.perf_counter()
+        self._changed()
+        try:
+            self.result = self._fn(*self._args, **self._kwargs)
+            self.status = 'done'
+        except Exception as e:
+            print(f"Ошибка в фоновой задаче {self.kind} {self.id}: {e}")
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            self.finished_at = datetime.now().isoformat()
+            self._finished = time.perf_counter()
+            self._fn = self._args = self._kwargs = None
+            self._changed()
+            self._done.set()
+
+    def cancel(self):
+        # задача из очереди, которая уже не будет выполнена (остановка JobManager)
+        self.status = 'cancelled'
+        self.error = 'Задача отменена'
+        self.finished_at = datetime.now().isoformat()
+        self._fn = self._args = self._kwargs = None
+        self._changed()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def timings(self):
+        # ожидание в очереди и выполнение, мс (для незавершенных этапов - на текущий момент)
+        now = time.perf_counter()
+        started = self._started or now
+        return {
+            'queue_wait_ms': round((started - self._queued) * 1000, 2),
+            'processing_ms': round(((self._finished or now) - started) * 1000, 2) if self._started else None,
+        }
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            **self.timings(),
+        }
+
+
+class JobManager:
+    # Фоновые задачи со статусом для опроса.
+    # Потоки запускаются лениво (и заново после fork()), очередь может быть ограничена.
+    # С store статусы видны всем процессам (см. status)
+
+    def __init__(self, workers=1, max_queue=0, max_jobs_kept=MAX_JOBS_KEPT, name='jobs', store=None):
+        self.workers = workers
+        self.name = name
+        self.max_jobs_kept = max_jobs_kept
+        self.store = store
+        self._queue = queue.Queue(max_queue)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._closed = False
+        self.rejected = 0
+
+    def _ensure_workers(self):
+        with self._lock:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            # после fork() потоки родителя в дочернем процессе не существуют
+            forked = self._pid != os.getpid()
+            self._pid = os.getpid()
+            self._threads = [] if forked else [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'{self.name}-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _save(self, job):
+        self.store.put(self.name, job)
+
+    def submit(self, fn, *args, kind=None, **kwargs):
+        if self._closed:
+            raise QueueFull(f"Очередь задач {self.name} остановлена")
+        job = Job(fn, args, kwargs, kind, on_change=self._save if self.store is not None else None)
+        self._ensure_workers()
+        # статус queued записывается до постановки в очередь - иначе он мог бы затереть running
+        job._changed()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            if self.store is not None:
+                self.store.delete(job.id)
+            raise QueueFull(f"Очередь задач {self.name} заполнена")
+
+        with self._lock:
+            self._jobs[job.id] = job
+            # старые задачи забываем, чтобы словарь не рос бесконечно
+            while len(self._jobs) > self.max_jobs_kept:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                del self._jobs[oldest_id]
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        # словарь статуса (с result для done) из этого процесса или из store; None - задачи нет
+        job = self.get(job_id)
+        if job is not None:
+            result = job.to_dict()
+            if job.status == 'done':
+                result['result'] = job.result
+            return result
+        if self.store is not None:
+            return self.store.get(self.name, job_id)
+        return None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def shutdown(self, wait=True, timeout=None, cancel=False):
+        # уже поставленные задачи выполняются до остановки (cancel=True - отменяются).
+        # Новые задачи не принимаются
+        self._closed = True
+        if cancel:
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    job.cancel()
+        threads = [t for t in self._threads if t.is_alive()]
+        for _ in threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                # ограниченная очередь заполнена - сигнал остановки ставится в фоне,
+                # вызывающий поток (например, запрос) не блокируется
+                threading.Thread(target=self._queue.put, args=(None,), daemon=True).start()
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for thread in threads:
+                thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
@@ -1,30 +1,142 @@
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import as_completed
+from startup import BACKGROUND_LOAD, DetectorLoader, ModelNotReady, warm_up
 import cv2
-import json
+import numpy as np
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, url_for
+from urllib.parse import urlparse
+from flask import (Flask, render_template, request, jsonify, send_file, send_from_directory, stream_with_context,
+                   url_for)
 from werkzeug.utils import secure_filename
-from model import MuzzleDetectorModel
+from model import MODEL_PATH, InferenceError, MuzzleDetectorModel, CONFIDENCE_THRESHOLD
+from annotate import RENDER_MODE, RENDER_MODES, draw_detections
+from detections import as_detections, decode_detections, encode_detections
+from metrics import rss_bytes, stages
+from prefilter import MotionPrefilter, ThresholdProfiles, profiles_path
+from rollups import DEFAULT_SOURCE
+from registry import SHADOW_SAMPLE_RATE, ModelManager, ModelRegistry
+from inference_queue import BatchInferenceQueue
+from storage import BackgroundWriter, UploadStorage
+from jobs import JobManager, JobStore, QueueFull
+from result_cache import ResultCache
+from video import VIDEO_EXTENSIONS, VIDEO_SOURCE, process_video
 
 # Конфигурация
 UPLOAD_FOLDER = 'static/uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+MAX_IMAGE_SIZE = 16 * 1024 * 1024  # 16MB max для изображений
+MAX_CONTENT_LENGTH = 512 * 1024 * 1024  # 512MB max (видео)
+SAVE_UPLOADS = True  # сохранять оригиналы и результаты на диск (в фоне)
+HISTORY_PAGE_SIZE = 50
+MAX_SOURCE_LENGTH = 100  # длина идентификатора источника (камеры)
+MAX_BATCH_FILES = 500  # изображений в одном запросе /upload/batch (включая содержимое zip)
+BATCH_UPLOAD_CHUNK = 32  # сколько кадров пакета одновременно декодировано и стоит в очереди инференса
+ASYNC_WORKERS = 4  # потоков асинхронной обработки загрузок (кадры собираются в батчи очередью инференса)
+ASYNC_MAX_QUEUE = 64  # сколько загрузок может ждать обработки; при переполнении - 429
+ASYNC_RETRY_AFTER = 5  # секунды в заголовке Retry-After
+CALLBACK_HOSTS = {'localhost', '127.0.0.1', '::1'}  # callback_url только на локальные адреса
+CALLBACK_TIMEOUT = 10
+MAX_HISTORY_PAGE_SIZE = 500
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['SAVE_UPLOADS'] = SAVE_UPLOADS
+
+# Папка загрузок (по часам, со сроком хранения и фоновой очисткой)
+uploads = UploadStorage(UPLOAD_FOLDER)
+# Статусы фоновых задач - в jobs.db, их видят все рабочие процессы serve.py
+job_store = JobStore()
+# Версии весов (активная, теневая) - в реестре моделей, общем для рабочих процессов
+registry = ModelRegistry(default_weights=MODEL_PATH)
+
+
+def load_candidate(weights):
+    # модель без истории, прогретая до подмены (см. ModelManager)
+    candidate = MuzzleDetectorModel(weights, history_backend=None)
+    warm_up(candidate)
+    return candidate
+
+
+def on_model_swap(name, weights):
+    # профили порогов лежат рядом с весами; фон предфильтра считался по детекциям прежней модели
+    profiles.use(profiles_path(weights))
+    prefilter.reset()
+
+
+def on_detector_ready(d):
+    # очистка хранилища стартует, когда доступна история
+    uploads.start(d.history)
+    models.sync()
+
 
-# Создаем папки, если их нет
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-# Инициализация модели
-detector = MuzzleDetectorModel()
+# Инициализация модели: загрузка и прогрев в фоне, готовность - /readyz
+detector = DetectorLoader(lambda: MuzzleDetectorModel(registry.weights(registry.active)), on_ready=on_detector_ready)
+models = ModelManager(registry, detector.get, load_candidate, on_swap=on_model_swap, store=job_store)
+# Очередь микробатчинга перед моделью
+inference_queue = BatchInferenceQueue(detector)
+# Запись файлов на диск вне пути ответа
+writer = BackgroundWriter()
+# Кэш результатов для повторяющихся изображений
+result_cache = ResultCache()
+# Фоновая генерация PDF-отчетов
+report_jobs = JobManager(workers=1, name='reports', store=job_store)
+# Пороги по источникам (файл рядом с весами) и предфильтр кадров без движения
+profiles = ThresholdProfiles(profiles_path(registry.weights(registry.active)))
+prefilter = MotionPrefilter()
+# загрузка модели - после создания всех объектов, которые использует on_ready
+detector.start(background=BACKGROUND_LOAD)
+# Асинхронная обработка загрузок (POST /upload?async=1)
+upload_jobs = JobManager(workers=ASYNC_WORKERS, max_queue=ASYNC_MAX_QUEUE, name='uploads', store=job_store)
+
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
 
 
 def allowed_file(filename):
     # проверка на расширение
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return file_extension(filename) in ALLOWED_EXTENSIONS
+
+
+def predict_frames(frames, render=True):
+    # батч кадров через общую очередь инференса
+    futures = [inference_queue.submit(frame, render=render) for frame in frames]
+    return [future.result() for future in futures]
+
+
+@app.errorhandler(ModelNotReady)
+def model_not_ready(error):
+    response = jsonify({'error': str(error), 'status': detector.status()})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.before_request
+def sync_models():
+    # версию модели мог сменить другой рабочий процесс - догоняем реестр (загрузка в фоне)
+    if detector.ready:
+        models.sync()
+
+
+@app.route('/healthz')
+def healthz():
+    # liveness: процесс отвечает (модель может еще загружаться)
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    # readiness: модель загружена и прогрета; в ответе - время импорта, загрузки и первого прогона
+    status = detector.status()
+    return jsonify(status), 200 if status['ready'] else 503
 
 
 @app.route('/')
@@ -44,107 +156,682 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
 
     if file and allowed_file(file.filename):
-        # Генерируем уникальное имя файла
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
         original_filename = secure_filename(file.filename)
-        filename = f"original_{timestamp}_{original_filename}"
-        original_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
-        # Сохраняем файл
-        file.save(original_path)
-        #print(f"Файл сохранен: {original_path}")  # debug
+        # источник (камера): свой порог и предфильтр - см. prefilter.py
+        source = request.values.get('source') or None
+        if source is not None and len(source) > MAX_SOURCE_LENGTH:
+            return jsonify({'error': 'source is too long'}), 400
+
+        if file_extension(original_filename) in VIDEO_EXTENSIONS:
+            return process_uploaded_video(file, original_filename, source)
+
+        # разметка: lazy - при первом GET processed_url, eager - сразу, none - только JSON
+        render = request.values.get('render', RENDER_MODE)
+        if render not in RENDER_MODES:
+            return jsonify({'error': f'render must be one of {", ".join(RENDER_MODES)}'}), 400
+
+        # не больше MAX_IMAGE_SIZE + 1 байт: лимит запроса (MAX_CONTENT_LENGTH) рассчитан на видео
+        data = file.read(MAX_IMAGE_SIZE + 1)
+        if len(data) > MAX_IMAGE_SIZE:
+            return jsonify({'error': 'File too large'}), 413
+
+        # асинхронный режим: сразу отвечаем id задачи, результат - опросом или на callback_url
+        try:
+            async_mode = parse_bool(request.values.get('async'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if async_mode:
+            return submit_upload_job(data, original_filename, render, request.values.get('callback_url'), source)
+
         # процессинг
-        return process_image(original_path, original_filename)
+        with stages.timer('request'):
+            return process_image(data, original_filename, render=render, source=source)
 
     return jsonify({'error': 'File type not allowed'}), 400
 
 
-def process_image(image_path, original_filename):
+def process_image(original_bytes, original_filename, confidence_threshold=None, render=RENDER_MODE, source=None):
     # Обработка изображения
-    #print(f"Обработка изображения: {image_path}")  # debug
+    try:
+        record, cached = analyze_image(original_bytes, original_filename, confidence_threshold, render, source)
+    except (ValueError, InferenceError):
+        return jsonify({'error': 'Failed to process image'}), 500
+    result = make_result(record, cached)
+    #print(f"Результат: {result}")  # debug
+    return jsonify(result)
 
-    # Получаем предсказания от модели
-    detections, processed_image = detector.predict(image_path)
 
-    if processed_image is None:
-        return jsonify({'error': 'Failed to process image'}), 500
+def analyze_image(original_bytes, original_filename, confidence_threshold=None, render=RENDER_MODE, source=None):
+    # decode -> инференс -> запись файлов и истории; возвращает (запись истории, из кэша ли)
+    profile = profiles.get(source)
+    if confidence_threshold is None:
+        confidence_threshold = profile['confidence'] or CONFIDENCE_THRESHOLD
+
+    # Одинаковые изображения отдаем из кэша без запуска модели
+    cache_key = result_cache.make_key(original_bytes, detector.model_version, confidence_threshold)
+    cached = cached_upload(cache_key, original_filename, render)
+    if cached is not None:
+        return detector.save_to_history(original_filename, *cached, source=source), True
+
+    frame = decode_image(original_bytes)
+
+    # Кадр без движения относительно фона камеры - детекции последнего прогона, без модели
+    detections = prefiltered(frame, source, profile)
+    skipped = detections is not None
+    if skipped:
+        processed_image = draw_detections(frame, detections) if render == 'eager' else None
+    else:
+        # Получаем предсказания от модели (копия с разметкой - только в режиме eager)
+        detections, processed_image = inference_queue.predict(frame, confidence_threshold, render=render == 'eager')
+        if profile['prefilter']:
+            prefilter.update(source or DEFAULT_SOURCE, detections)
+
+    if render == 'eager' and processed_image is None:
+        raise ValueError("Не удалось разметить изображение")
+
+    # детекции, взятые у предыдущего кадра, в кэш по содержимому этого изображения не кладем
+    processed_filename, original_image = store_upload(original_bytes, original_filename, cache_key,
+                                                      detections, processed_image, render, cache=not skipped)
+    # пропущенные предфильтром кадры считаются отдельно (rollups.skipped)
+    extra = {'prefilter_skipped': True} if skipped else {}
+    record = detector.save_to_history(original_filename, detections, processed_filename, original_image,
+                                      source=source, **extra)
+    return record, False
+
+
+def prefiltered(frame, source, profile):
+    # детекции без запуска модели (сцена не изменилась) или None
+    if not profile['prefilter']:
+        return None
+    with stages.timer('prefilter'):
+        return prefilter.check(source or DEFAULT_SOURCE, frame, profile)
+
+
+def cached_upload(cache_key, original_filename, render):
+    # (detections, processed_filename, original_image) из кэша результатов или None
+    cached = result_cache.get(cache_key)
+    if cached is None:
+        return None
+    if cached['original_image'] and uploads.resolve(cached['original_image']) is None:
+        # файлы из кэша уже удалены очисткой хранилища
+        return None
+    processed_filename = cached['processed_image']
+    if render == 'none':
+        processed_filename = None
+    elif processed_filename is None and cached['original_image']:
+        # в кэше результат без разметки - она нарисуется при первом обращении
+        processed_filename = uploads.new_name('processed', original_filename)
+    return as_detections(cached['detections']), processed_filename, cached['original_image']
+
+
+def decode_image(original_bytes):
+    # Декодируем файл из памяти один раз, без записи на диск
+    with stages.timer('decode'):
+        frame = cv2.imdecode(np.frombuffer(original_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError("Не удалось декодировать изображение")
+    return frame
+
+
+def store_upload(original_bytes, original_filename, cache_key, detections, processed_image, render, cache=True):
+    # Генерируем уникальные имена файлов (в папке текущего часа)
+    now = datetime.now()
+    original_image = None
+    processed_filename = None
+
+    # Сохраняем оригинал (и в режиме eager - обработанное изображение) в фоне.
+    # В режиме lazy обработанное изображение рисуется по истории при первом GET
+    if app.config['SAVE_UPLOADS']:
+        original_image = uploads.new_name('original', original_filename, now)
+        writer.write_bytes(uploads.path(original_image), original_bytes)
+        if render != 'none':
+            processed_filename = uploads.new_name('processed', original_filename, now)
+        if render == 'eager':
+            writer.write_image(uploads.path(processed_filename), processed_image)
+
+    if cache:
+        result_cache.put(cache_key, {
+            'detections': encode_detections(detections),
+            'processed_image': processed_filename,
+            'original_image': original_image,
+        })
+    return processed_filename, original_image
+
+
+def make_result(record, cached=False):
+    # Подготовка ответа
+    original_image = record.get('original_image')
+    processed_filename = record.get('processed_image')
+    return {
+        'success': True,
+        'cached': cached,
+        'original_filename': record['filename'],
+        'processed_filename': processed_filename,
+        'original_url': url_for('uploaded_file', filename=original_image) if original_image else None,
+        'processed_url': url_for('uploaded_file', filename=processed_filename) if processed_filename else None,
+        # детекции в формате API - списком словарей
+        'detections': decode_detections(record['detections']),
+        'stats': record['stats'],
+        # модель не запускалась: сцена не изменилась с прошлого кадра источника
+        'prefilter_skipped': bool(record.get('prefilter_skipped')),
+    }
 
-    # Сохраняем обработанное изображение
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-    processed_filename = f"processed_{timestamp}_{original_filename}"
-    processed_path = os.path.join(app.config['UPLOAD_FOLDER'], processed_filename)
 
-    # Сохраняем изображение
-    success = cv2.imwrite(processed_path, processed_image)
-    if not success:
-        return jsonify({'error': 'Failed to save processed image'}), 500
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    # Много изображений (поля files/file, можно zip-архивы) в одном запросе.
+    # Ответ - NDJSON: строка на изображение по мере готовности, последняя строка - итог
+    render = request.values.get('render', RENDER_MODE)
+    if render not in RENDER_MODES:
+        return jsonify({'error': f'render must be one of {", ".join(RENDER_MODES)}'}), 400
 
-    #print(f"Обработанный файл сохранен: {processed_path}")  # debug
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file part'}), 400
+    source = request.values.get('source') or None
+    if source is not None and len(source) > MAX_SOURCE_LENGTH:
+        return jsonify({'error': 'source is too long'}), 400
 
-    # Сохраняем в историю
-    record = detector.save_to_history(original_filename, detections, processed_filename)
+    opened = []
+    try:
+        items, skipped = collect_batch_files(files, opened)
+    except zipfile.BadZipFile:
+        close_all(opened)
+        return jsonify({'error': 'Bad zip archive'}), 400
+    if len(items) > MAX_BATCH_FILES:
+        close_all(opened)
+        return jsonify({'error': f'Too many images (max {MAX_BATCH_FILES})'}), 413
+
+    def lines():
+        try:
+            for result in process_batch(items, skipped, render=render, source=source):
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+        finally:
+            close_all(opened)
+
+    return app.response_class(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+
+def collect_batch_files(files, opened):
+    # [(имя, чтение байтов)] изображений и [(имя, ошибка)] пропущенных файлов.
+    # Отдельные изображения читаются сразу (их объем ограничен MAX_CONTENT_LENGTH), а файлы zip
+    # распаковываются в process_batch по BATCH_UPLOAD_CHUNK кадров - распакованный архив целиком
+    # в памяти не держится. Открытые архивы добавляются в opened (закрыть - close_all)
+    items, skipped = [], []
+
+    def add(name, size, read):
+        name = secure_filename(os.path.basename(name))
+        if file_extension(name) not in IMAGE_EXTENSIONS:
+            skipped.append((name, 'File type not allowed'))
+        elif size is not None and size > MAX_IMAGE_SIZE:
+            skipped.append((name, 'File too large'))
+        else:
+            items.append((name, read))
+
+    def read_entry(archive, info):
+        # не больше MAX_IMAGE_SIZE + 1 байт, даже если размер в заголовке zip занижен
+        with archive.open(info) as entry:
+            return entry.read(MAX_IMAGE_SIZE + 1)
+
+    for file in files:
+        if file_extension(file.filename or '') == 'zip':
+            # загруженные файлы закрываются после выхода из view, а ответ еще отдается -
+            # сжатый архив копируется во временный файл
+            spool = tempfile.TemporaryFile()
+            opened.append(spool)
+            shutil.copyfileobj(file.stream, spool)
+            spool.seek(0)
+            archive = zipfile.ZipFile(spool)
+            opened.append(archive)
+            for info in archive.infolist():
+                if not info.is_dir():
+                    # размер проверяется до распаковки
+                    add(info.filename, info.file_size, lambda archive=archive, info=info: read_entry(archive, info))
+                    if len(items) > MAX_BATCH_FILES:
+                        return items, skipped
+        elif file.filename:
+            data = file.read(MAX_IMAGE_SIZE + 1)
+            add(file.filename, None, lambda data=data: data)
+    return items, skipped
+
+
+def close_all(opened):
+    # архивы закрываются раньше своих временных файлов
+    for item in reversed(opened):
+        item.close()
+
+
+def process_batch(items, skipped=(), confidence_threshold=None, render=RENDER_MODE, source=None):
+    # Кадры пакета читаются и ставятся в очередь инференса по BATCH_UPLOAD_CHUNK (она собирает их в батчи модели),
+    # результат отдается, как только готов; история пишется одной пакетной записью на каждую часть
+    for name, error in skipped:
+        yield {'success': False, 'original_filename': name, 'error': error}
+
+    profile = profiles.get(source)
+    if confidence_threshold is None:
+        confidence_threshold = profile['confidence'] or CONFIDENCE_THRESHOLD
+    records = []
+    failed = len(skipped)
+    committed = 0
+
+    def commit():
+        # время записей - момент фиксации (см. save_many_to_history): клиент, опрашивающий
+        # /history?after=<курсор>, не пропустит пакет из-за записей "в прошлом"
+        nonlocal committed
+        if records:
+            detector.save_many_to_history(records)
+            committed += len(records)
+            records.clear()
+
+    def finish(index, name, data, cache_key, detections, processed_image, prefilter_skipped=False):
+        processed_filename, original_image = store_upload(data, name, cache_key, detections, processed_image, render,
+                                                          cache=not prefilter_skipped)
+        extra = {'prefilter_skipped': True} if prefilter_skipped else {}
+        record = detector.make_record(name, detections, processed_filename, original_image, source, **extra)
+        records.append(record)
+        return {'index': index, **make_result(record)}
 
-    # Подготовка ответа
-    result = {
+    try:
+        for start in range(0, len(items), BATCH_UPLOAD_CHUNK):
+            pending = {}
+            for index, (name, read) in enumerate(items[start:start + BATCH_UPLOAD_CHUNK], start):
+                try:
+                    data = read()
+                except (OSError, zipfile.BadZipFile) as e:
+                    failed += 1
+                    yield {'index': index, 'success': False, 'original_filename': name, 'error': str(e)}
+                    continue
+                if len(data) > MAX_IMAGE_SIZE:
+                    failed += 1
+                    yield {'index': index, 'success': False, 'original_filename': name, 'error': 'File too large'}
+                    continue
+                cache_key = result_cache.make_key(data, detector.model_version, confidence_threshold)
+                cached = cached_upload(cache_key, name, render)
+                if cached is not None:
+                    record = detector.make_record(name, *cached, source=source)
+                    records.append(record)
+                    yield {'index': index, **make_result(record, cached=True)}
+                    continue
+                try:
+                    frame = decode_image(data)
+                except ValueError:
+                    failed += 1
+                    yield {'index': index, 'success': False, 'original_filename': name,
+                           'error': 'Failed to process image'}
+                    continue
+                detections = prefiltered(frame, source, profile)
+                if detections is not None:
+                    processed_image = draw_detections(frame, detections) if render == 'eager' else None
+                    yield finish(index, name, data, cache_key, detections, processed_image, prefilter_skipped=True)
+                    continue
+                future = inference_queue.submit(frame, confidence_threshold, render=render == 'eager')
+                pending[future] = (index, name, data, cache_key)
+
+            for future in as_completed(pending):
+                index, name, data, cache_key = pending.pop(future)
+                try:
+                    detections, processed_image = future.result()
+                    if render == 'eager' and processed_image is None:
+                        raise ValueError("Не удалось разметить изображение")
+                except Exception as e:
+                    failed += 1
+                    yield {'index': index, 'success': False, 'original_filename': name, 'error': str(e)}
+                    continue
+                if profile['prefilter']:
+                    prefilter.update(source or DEFAULT_SOURCE, detections)
+                yield finish(index, name, data, cache_key, detections, processed_image)
+            commit()
+    finally:
+        # и при обрыве соединения обработанные изображения попадают в историю
+        commit()
+
+    # после итоговой строки записи есть в истории (lazy-разметка доступна по processed_url)
+    yield {'done': True, 'processed': committed, 'failed': failed}
+
+
+def submit_upload_job(data, original_filename, render, callback_url=None, source=None):
+    if callback_url and urlparse(callback_url).hostname not in CALLBACK_HOSTS:
+        return jsonify({'error': 'callback_url must point to a local address'}), 400
+    try:
+        # ссылки на изображения в ответе callback строятся от адреса этого запроса
+        job = upload_jobs.submit(run_upload_job, data, original_filename, render, callback_url,
+                                 request.host_url, source, kind='upload')
+    except QueueFull:
+        # очередь заполнена - клиент повторяет позже, а не ждет до таймаута
+        response = jsonify({'error': 'Upload queue is full', 'queue_depth': upload_jobs.queue_depth()})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(ASYNC_RETRY_AFTER)
+        return response
+    return jsonify({**job.to_dict(), 'status_url': url_for('upload_job_status', job_id=job.id)}), 202
+
+
+def run_upload_job(data, original_filename, render, callback_url, base_url, source=None):
+    # результат - готовый ответ (как у /upload): он сохраняется в jobs.db
+    # и отдается из любого рабочего процесса
+    with stages.timer('request'):
+        record, cached = analyze_image(data, original_filename, render=render, source=source)
+    with app.test_request_context(base_url=base_url):
+        result = make_result(record, cached)
+    if callback_url:
+        send_callback(callback_url, {'status': 'done', **result})
+    return result
+
+
+def send_callback(callback_url, payload):
+    # ошибка доставки не отменяет результат - он остается доступен опросом
+    import urllib.request
+
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    callback = urllib.request.Request(callback_url, data=body, method='POST',
+                                      headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(callback, timeout=CALLBACK_TIMEOUT) as response:
+            response.read()
+    except OSError as e:
+        print(f"Не удалось отправить результат на {callback_url}: {e}")
+
+
+@app.route('/jobs/<job_id>')
+def upload_job_status(job_id):
+    # статус асинхронной загрузки: queued / running / done / failed,
+    # время ожидания в очереди и обработки; для done - тот же ответ, что и у /upload.
+    # Статус - из jobs.db: задачу мог принять другой рабочий процесс
+    job = upload_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+def process_uploaded_video(file, original_filename, source=None):
+    # OpenCV читает видео только из файла, поэтому сохраняем его во временный файл
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], f"video_{timestamp}_{original_filename}")
+    file.save(video_path)
+    try:
+        stats, detections, preview, counters = process_video(
+            detector, video_path, filename=original_filename, predict_batch=predict_frames,
+            history_source=source or VIDEO_SOURCE)
+    except IOError as e:
+        return jsonify({'error': str(e)}), 400
+    except InferenceError:
+        return jsonify({'error': 'Failed to process video'}), 500
+    finally:
+        os.unlink(video_path)
+
+    # Кадр с наибольшим числом собак сохраняем как результат
+    processed_filename = None
+    if preview is not None and app.config['SAVE_UPLOADS']:
+        processed_filename = uploads.new_name('processed', f"{os.path.splitext(original_filename)[0]}.jpg")
+        writer.write_image(uploads.path(processed_filename), preview)
+
+    return jsonify({
         'success': True,
+        'type': 'video',
         'original_filename': original_filename,
         'processed_filename': processed_filename,
-        'original_url': url_for('uploaded_file', filename=os.path.basename(image_path)),
-        'processed_url': url_for('uploaded_file', filename=processed_filename),
+        'original_url': None,
+        'processed_url': url_for('uploaded_file', filename=processed_filename) if processed_filename else None,
         'detections': detections,
-        'stats': record['stats']
-    }
-
-    #print(f"Результат: {result}")  # debug
-    return jsonify(result)
+        'stats': stats,
+        'frames': counters,
+    })
 
 
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     # Подгружаем файл из uploads на страницу
-    try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    except FileNotFoundError:
-        # Если файл не найден, возвращаем placeholder
+    # (если файл еще пишется в фоне - дожидаемся записи)
+    writer.wait(filename)
+    stored = uploads.resolve(filename)
+    if stored is None and os.path.basename(filename).startswith('processed_'):
+        # изображение с разметкой рисуется при первом обращении
+        detector.render_processed_image(filename, app.config['UPLOAD_FOLDER'], wait=writer.wait)
+        stored = uploads.resolve(filename)
+    if stored is None:
+        # Если файл не найден (или удален по сроку хранения), возвращаем placeholder
         return send_from_directory('static', 'placeholder.jpg')
+    # старые обработанные изображения могли быть пережаты в другой формат
+    return send_from_directory(app.config['UPLOAD_FOLDER'], stored)
+
+
+def parse_bool(value):
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"Ожидается 0/1: {value}")
 
 
 @app.route('/history')
 def get_history():
-    # история обработки
-    history = detector.get_history()
+    # История обработки постранично, от новых к старым:
+    # /history?limit=50&before=<timestamp>  - следующая (более старая) страница
+    # /history?after=<timestamp>            - записи новее курсора
+    # фильтры: label, min_confidence, has_without_muzzle=0/1; fields=timestamp,filename,stats
+    # ETag зависит от версии истории и параметров запроса - без изменений ответ 304
+    etag = hashlib.md5(f"{detector.history_version()}|{request.query_string.decode()}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
 
-    # Добавляем полные URL к каждому элементу истории
-    for record in history:
-        if 'processed_image' in record:
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE_SIZE))
+        min_confidence = request.args.get('min_confidence')
+        filters = {
+            'before': request.args.get('before'),
+            'after': request.args.get('after'),
+            'label': request.args.get('label'),
+            'min_confidence': float(min_confidence) if min_confidence is not None else None,
+            'has_without_muzzle': parse_bool(request.args.get('has_without_muzzle')),
+        }
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    fields = request.args.get('fields')
+    fields = set(fields.split(',')) | {'timestamp'} if fields else None
+
+    # запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+    records = detector.get_history_page(limit=limit + 1, **filters)
+    has_more = len(records) > limit
+    if has_more:
+        # для after лишняя запись - самая новая, иначе - самая старая
+        records = records[1:] if filters['after'] and not filters['before'] else records[:-1]
+
+    # Добавляем полные URL к каждому элементу страницы
+    for record in records:
+        if record.get('processed_image'):
             record['processed_url'] = url_for('uploaded_file', filename=record['processed_image'])
-
-    return jsonify(history)
+    if fields:
+        records = [{key: value for key, value in record.items() if key in fields} for record in records]
+
+    response = jsonify({
+        'items': records,
+        'has_more': has_more,
+        # курсоры для соседних страниц
+        'next_cursor': records[-1]['timestamp'] if records else None,
+        'prev_cursor': records[0]['timestamp'] if records else None,
+    })
+    response.set_etag(etag)
+    # браузер каждый раз перепроверяет ответ по ETag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/stats')
+def get_stats():
+    # метрики очереди инференса: глубина, размеры батчей, задержки по этапам;
+    # кадры, пропущенные предфильтром, - отдельно по источникам
+    return jsonify({'inference': inference_queue.stats(), 'cache': result_cache.stats(),
+                    'prefilter': prefilter.stats()})
+
+
+@app.route('/metrics')
+def metrics():
+    # Метрики в формате Prometheus: длительность этапов (decode, preprocess, forward,
+    # postprocess, plot, encode, history_write, ...), очередь инференса, кэш, память
+    inference = inference_queue.stats()
+    cache = result_cache.stats()
+    filtered = prefilter.stats()
+    shadow = detector.shadow.stats() if detector.ready and detector.shadow is not None else {}
+    text = stages.render(
+        gauges={
+            'inference_queue_depth': inference['queue_depth'],
+            'upload_jobs_queue_depth': upload_jobs.queue_depth(),
+            'cache_memory_entries': cache['memory_entries'],
+            'process_resident_memory_bytes': rss_bytes(),
+            'shadow_agreement': shadow.get('agreement'),
+        },
+        counters={
+            'inference_batches_total': inference['batches'],
+            'upload_jobs_rejected_total': upload_jobs.rejected,
+            'prefilter_frames_total': filtered['frames'],
+            'prefilter_skipped_total': filtered['skipped'],
+            'shadow_compared_total': shadow.get('compared', 0),
+            'cache_memory_hits_total': cache['memory_hits'],
+            'cache_disk_hits_total': cache['disk_hits'],
+            'cache_misses_total': cache['misses'],
+        })
+    return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats/aggregate')
+def get_aggregate_stats():
+    # Статистика по окнам времени: /stats/aggregate?granularity=day&start=2024-05-01&end=2024-06-01
+    # source - только один источник, by_source=1 - разбивка по источникам
+    granularity = request.args.get('granularity', 'hour')
+    try:
+        buckets = detector.get_aggregates(granularity,
+                                          start=request.args.get('start'),
+                                          end=request.args.get('end'),
+                                          source=request.args.get('source'),
+                                          by_source=request.args.get('by_source') == '1')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'granularity': granularity,
+        'granularities': list(detector.rollups.granularities),
+        'sources': detector.rollups.sources(),
+        'buckets': buckets,
+    })
+
+
+@app.route('/report', methods=['POST'])
+def start_report():
+    # Запускает генерацию отчета в фоне, статус опрашивается по status_url
+    job = report_jobs.submit(detector.generate_pdf_report, kind='report')
+    return jsonify({**job.to_dict(), 'status_url': url_for('report_status', job_id=job.id)}), 202
+
+
+@app.route('/report/<job_id>')
+def report_status(job_id):
+    # статус - из jobs.db: задачу мог принять другой рабочий процесс
+    job = report_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    # путь к файлу на сервере в ответ не попадает
+    report_path = job.pop('result', None)
+    if job['status'] == 'done' and not report_path:
+        job.update(status='failed', error='Failed to generate report')
+    elif job['status'] == 'done':
+        job['download_url'] = url_for('report_download', job_id=job_id)
+    return jsonify(job)
+
+
+@app.route('/report/<job_id>/download')
+def report_download(job_id):
+    # Отдает готовый отчет (папка отчетов общая для всех процессов)
+    job = report_jobs.status(job_id)
+    if job is None or job['status'] != 'done':
+        return jsonify({'error': 'Report is not ready'}), 404
+    report_path = job.get('result')
+    if report_path and os.path.exists(report_path):
+        return send_file(report_path, as_attachment=True)
+    return jsonify({'error': 'Failed to generate report'}), 500
 
 
 @app.route('/report')
 def generate_report():
-    # Генерирует и отдает отчет
+    # Синхронный вариант (для старых клиентов): генерирует и сразу отдает отчет
     report_path = detector.generate_pdf_report()
     if report_path and os.path.exists(report_path):
         return send_file(report_path, as_attachment=True)
     return jsonify({'error': 'Failed to generate report'}), 500
 
 
+@app.route('/models')
+def models_status():
+    # реестр версий весов: активная, теневая (со статистикой сравнения), model_version - хэш весов
+    return jsonify(models.status())
+
+
+@app.route('/models', methods=['POST'])
+def add_model():
+    # регистрация версии: {"name": "v2", "weights": "models/v2.pt"}
+    data = request.get_json(silent=True) or request.form
+    try:
+        registry.add(data.get('name'), data.get('weights') or '')
+    except (TypeError, ValueError, FileNotFoundError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(registry.to_dict()), 201
+
+
+@app.route('/models/<name>/activate', methods=['POST'])
+def activate_model(name):
+    # загрузка и прогрев в фоне, затем подмена без остановки сервера
+    try:
+        job = models.activate(name)
+    except KeyError as e:
+        return jsonify({'error': str(e.args[0])}), 404
+    except QueueFull:
+        return jsonify({'error': 'Another model is being loaded'}), 409
+    return jsonify({**job.to_dict(), 'status_url': url_for('model_job_status', job_id=job.id)}), 202
+
+
+@app.route('/models/<name>/shadow', methods=['POST'])
+def shadow_model(name):
+    # A/B в тени: доля кадров (sample_rate) дополнительно прогоняется через версию name
+    try:
+        sample_rate = float(request.args.get('sample_rate', SHADOW_SAMPLE_RATE))
+    except ValueError:
+        return jsonify({'error': 'Invalid sample_rate'}), 400
+    if not 0 < sample_rate <= 1:
+        return jsonify({'error': 'sample_rate must be in (0, 1]'}), 400
+    try:
+        job = models.start_shadow(name, sample_rate)
+    except KeyError as e:
+        return jsonify({'error': str(e.args[0])}), 404
+    except QueueFull:
+        return jsonify({'error': 'Another model is being loaded'}), 409
+    return jsonify({**job.to_dict(), 'status_url': url_for('model_job_status', job_id=job.id)}), 202
+
+
+@app.route('/models/shadow', methods=['DELETE'])
+def stop_shadow_model():
+    models.clear_shadow()
+    return jsonify(models.status())
+
+
+@app.route('/models/jobs/<job_id>')
+def model_job_status(job_id):
+    # статус - из jobs.db: загрузку мог принять другой рабочий процесс
+    job = models.jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     try:
-        # Получаем список всех файлов в папке
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                print(f"Ошибка при удалении файла {file_path}: {e}")
-
-        with open('history.json', 'w', encoding='utf-8') as f:
-            json.dump([], f)
+        # папки загрузок и миниатюр освобождаются сразу, файлы удаляются в фоне
+        uploads.clear()
+        detector.clear_history()
+        # файлы удалены - закэшированные ссылки на них больше не действительны
+        result_cache.clear()
 
         return jsonify({'success': True, 'message': 'История и файлы очищены'})
     except Exception as e:
@@ -155,11 +842,12 @@ if __name__ == "__main__":
     # Создаем placeholder изображение, если его нет
     placeholder_path = "static/placeholder.jpg"
     if not os.path.exists(placeholder_path):
-        import numpy as np
-
         placeholder_img = np.zeros((300, 300, 3), dtype=np.uint8)
         cv2.putText(placeholder_img, 'No image', (80, 150),
                     cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
         cv2.imwrite(placeholder_path, placeholder_img)
 
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Режим разработки. Без перезагрузчика, иначе модель загружается дважды.
+    # Для продакшена используйте serve.py
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, threaded=True,
+            host='0.0.0.0', port=5000)
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# границы гистограмм длительности этапов, секунды
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PREFIX = "muzzle"
+
+
+def summarize(samples_ms):
+    # сводка по замерам задержки в миллисекундах
+    samples = sorted(samples_ms)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p / 100))], 2)
+
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples), 2),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': round(samples[-1], 2),
+    }
+
+
+def rss_bytes():
+    # текущая резидентная память процесса (psutil - если установлен)
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageMetrics:
+    # Гистограммы длительности этапов обработки (decode, forward, history_write, ...).
+    # В gunicorn у каждого процесса свои счетчики
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                stats['buckets'][index] += 1
+            stats['sum'] += seconds
+            stats['count'] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {'buckets': list(s['buckets']), 'sum': s['sum'], 'count': s['count']}
+                    for stage, s in self._stages.items()}
+
+    def summary(self):
+        # среднее время этапа в миллисекундах (для бенчмарка)
+        return {stage: {'count': s['count'], 'mean_ms': round(s['sum'] / s['count'] * 1000, 3)}
+                for stage, s in self.snapshot().items() if s['count']}
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def render(self, gauges=None, counters=None):
+        # текстовый формат Prometheus (text/plain; version=0.0.4)
+        name = f"{METRICS_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Длительность этапов обработки изображения",
+                 f"# TYPE {name} histogram"]
+        for stage, stats in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, stats['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+
+        for kind, values in (('gauge', gauges or {}), ('counter', counters or {})):
+            for metric, value in sorted(values.items()):
+                if value is None:
+                    continue
+                lines.append(f"# TYPE {METRICS_PREFIX}_{metric} {kind}")
+                lines.append(f"{METRICS_PREFIX}_{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+# общий реестр этапов процесса
+stages = StageMetrics()
@@ -1,8 +1,16 @@
+import os
+import threading
+import time
 import cv2
-from ultralytics import YOLO
-import json
 from datetime import datetime
-from pathlib import Path
+from detections import Detections, as_detections
+from backends import INFERENCE_BACKEND, INT8, file_hash, resolve_weights, save_fused
+from history_store import HISTORY_BACKEND, create_history_store, migrate_legacy_history
+from rollups import ROLLUPS_DB, RollupStore
+from annotate import render_to_file
+from metrics import stages
+from storage import find_stored, get_thumbnail
+from tiling import TILED_INFERENCE, predict_tiled
 
 
 MODEL_PATH = "best_muzzle_model_yolo26m.pt"
@@ -10,126 +18,285 @@ HISTORY_FILE = "history.json"
 FONT_PATH = "./DejaVuSans.ttf"
 CONFIDENCE_THRESHOLD = 0.5
 REPORTS_PATH = "./reports"
+UPLOADS_PATH = "./static/uploads"
+REPORT_FONT_NAME = "RussianFont"
+REPORT_RECENT_IMAGES = 10
 
+class InferenceError(RuntimeError):
+    # ошибка прогона модели: пустые детекции вместо нее попали бы в кэш и историю
+    pass
 
-class MuzzleDetectorModel:
 
-    def __init__(self, model_path=MODEL_PATH, history_file=HISTORY_FILE):
+_font_lock = threading.Lock()
+_font_registered = False
+
+
+def register_report_font():
+    # шрифт с кириллицей регистрируется в reportlab один раз на процесс
+    global _font_registered
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    import os
+
+    with _font_lock:
+        if not _font_registered and os.path.exists(FONT_PATH):
+            try:
+                pdfmetrics.registerFont(TTFont(REPORT_FONT_NAME, FONT_PATH))
+                #print(f"Зарегистрирован шрифт с кириллицей: {FONT_PATH}")
+            except Exception as e:
+                print(f"Не удалось зарегистрировать {FONT_PATH}: {e}")
+            _font_registered = True
+    return REPORT_FONT_NAME
 
-        self.device = 'cpu'
-        print(f"Используется устройство: {self.device}")
-        # Загружаем модель
+
+class MuzzleDetectorModel:
+
+    def __init__(self, model_path=MODEL_PATH, history_file=HISTORY_FILE,
+                 history_backend=HISTORY_BACKEND, history_path=None,
+                 backend=INFERENCE_BACKEND, int8=INT8, device='cpu', rollups_path=ROLLUPS_DB,
+                 tiled=TILED_INFERENCE, tile_options=None):
+
+        self.device = device
+        self.backend = backend
+        # нарезка кадра на тайлы (параметры - см. predict_tiled)
+        self.tiled = tiled
+        self.tile_options = tile_options or {}
+        # теневая модель для A/B-сравнения (см. registry.ShadowEvaluator)
+        self.shadow = None
+        print(f"Используется устройство: {self.device}, backend: {self.backend}")
+        # Загружаем модель (для onnx/openvino - экспортированную из тех же весов)
         print(f"Загрузка модели из файла весов: {model_path}")
         try:
-            self.model = YOLO(model_path)
+            # ultralytics/torch импортируются только здесь - остальные модули грузятся быстро
+            from ultralytics import YOLO
+            self.model_path = model_path
+            model = YOLO(resolve_weights(model_path, backend, int8), task='detect')
+            # версия модели: хэш весов + backend (используется в ключах кэша и в записях истории)
+            version = f"{file_hash(model_path)}-{backend}{'-int8' if int8 and backend != 'pytorch' else ''}"
+            if tiled:
+                version += '-tiled'
+            # модель, ее версия и блокировка меняются одним присваиванием (см. adopt);
+            # predictor ultralytics не потокобезопасен - вызовы одной модели идут по одному
+            self._engine = (model, version, threading.Lock())
             print(f"Модель успешно загружена")
             #print(f"Имена классов модели: {self.model.names}") #debug
         except Exception as e:
             print(f"Ошибка загрузки модели: {e}")
             raise
 
-        self.history_file = history_file
-        if not Path(self.history_file).exists():
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
-
-    def predict(self, image_path, confidence_threshold=CONFIDENCE_THRESHOLD):
-        # Загружаем изображение
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"Не удалось загрузить изображение: {image_path}")
-            return [], img
-        # инференс
+        # хранилище истории; старый history.json переносится один раз
+        # (history_backend=None - без истории, например в рабочих процессах)
+        self.history = None
+        self.rollups = None
+        if history_backend is not None:
+            self.history = create_history_store(history_backend, history_path)
+            migrate_legacy_history(self.history, history_file)
+            # агрегаты по окнам времени; для уже накопленной истории считаются один раз
+            self.rollups = RollupStore(rollups_path)
+            if self.rollups.empty() and self.history.count():
+                self.rollups.rebuild(self.history)
+
+    @property
+    def model(self):
+        return self._engine[0]
+
+    @property
+    def model_version(self):
+        return self._engine[1]
+
+    def adopt(self, other):
+        # Горячая замена весов: берем уже загруженную и прогретую модель другого экземпляра.
+        # Батчи, начатые на прежней модели, досчитываются на ней
+        self.model_path = other.model_path
+        self._engine = other._engine
+        print(f"Модель заменена: {other.model_path} ({other.model_version})")
+
+    def predict(self, image, confidence_threshold=CONFIDENCE_THRESHOLD, render=True):
+        # image - путь к файлу или уже декодированный кадр (BGR)
+        return self.predict_batch([image], confidence_threshold, render)[0]
+
+    def predict_batch(self, images, confidence_threshold=CONFIDENCE_THRESHOLD, render=True):
+        # render=False - только детекции, без копии кадра с разметкой (вместо нее None)
+        # снимок модели: замена весов во время батча его не затрагивает
+        model, version, lock = self._engine
+
+        def run_model(frames, threshold):
+            return self._run_model(model, lock, frames, threshold)
+
+        # Загружаем изображения
+        frames = [self._load_image(image) for image in images]
+        outputs = [(Detections(names=model.names, model_version=version), img) for img in frames]
+        valid = [i for i, img in enumerate(frames) if img is not None]
+        if not valid:
+            return outputs
+
+        # инференс одним батчем (в режиме тайлов - батчами тайлов всех кадров)
         try:
-            results = self.model(image_path, conf=confidence_threshold, device=self.device)
+            batch = [frames[i] for i in valid]
+            started = time.perf_counter()
+            if self.tiled:
+                results = predict_tiled(run_model, batch, confidence_threshold, **self.tile_options)
+            else:
+                results = run_model(batch, confidence_threshold)
+            elapsed_ms = (time.perf_counter() - started) * 1000 / len(batch)
         except Exception as e:
             print(f"Ошибка во время инференса: {e}")
-            return [], img
-
-        detections = []
-
-        # Получаем результаты
-        if results[0].boxes is not None and len(results[0].boxes) > 0:
-            boxes = results[0].boxes.xyxy.cpu().numpy()
-            confidences = results[0].boxes.conf.cpu().numpy()
-            class_ids = results[0].boxes.cls.cpu().numpy()
-
-            for i, (box, conf, class_id) in enumerate(zip(boxes, confidences, class_ids)):
-                # Получаем имя класса
-                class_id_int = int(class_id)
-                if class_id_int < len(self.model.names):
-                    label = self.model.names[class_id_int]
-                else:
-                    label = f"class_{class_id_int}"
-
-                detections.append({
-                    "bbox": box.tolist(),  # [x1, y1, x2, y2]
-                    "label": label,
-                    "confidence": float(conf),
-                    "class_id": class_id_int
-                })
-
-            #print(f"Обнаружено объектов: {len(detections)}")  #debug
-
-        # Получаем изображение с аннотациями
-        output_img = results[0].plot() if len(results) > 0 else img.copy()
-
-        return detections, output_img
-
-    def save_to_history(self, filename, detections, processed_filename):
+            raise InferenceError(f"Ошибка во время инференса: {e}") from e
+
+        for i, result in zip(valid, results):
+            # Получаем изображение с аннотациями
+            annotated = None
+            if render:
+                with stages.timer('plot'):
+                    annotated = result.plot()
+            outputs[i] = (self._parse_result(result, version), annotated)
+
+        shadow = self.shadow
+        if shadow is not None:
+            # выборка кадров уходит кандидату в фоне, ответ не ждет
+            shadow.submit(batch, [outputs[i][0] for i in valid], confidence_threshold, elapsed_ms)
+        return outputs
+
+    def cache_fused_model(self):
+        # после первого прогона слои Conv+BN уже свернуты - сохраняем эту копию,
+        # чтобы при следующих запусках не сворачивать их заново
+        if self.backend != 'pytorch' or getattr(self.model, 'predictor', None) is None:
+            return None
+        return save_fused(self.model, self.model_path)
+
+    def _run_model(self, model, lock, frames, confidence_threshold):
+        with lock:
+            results = model(frames, conf=confidence_threshold, device=self.device)
+        # ultralytics замеряет этапы сам (мс на изображение)
+        for result in results:
+            for stage, key in (('preprocess', 'preprocess'), ('forward', 'inference'), ('postprocess', 'postprocess')):
+                if result.speed.get(key) is not None:
+                    stages.observe(stage, result.speed[key] / 1000)
+        return results
+
+    @staticmethod
+    def _load_image(image):
+        if not isinstance(image, str):
+            return image
+        img = cv2.imread(image)
+        if img is None:
+            print(f"Не удалось загрузить изображение: {image}")
+        return img
 
-        with open(self.history_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
+    @staticmethod
+    def _parse_result(result, model_version=None):
+        # рамки, уверенности и классы остаются массивами; список словарей - только в ответе API
+        return Detections.from_result(result, result.names, model_version)
 
-        # статистика по изображению
-        stats = {
-            "total_dogs": len(detections),
-            "with_muzzle": sum(1 for d in detections if d.get("label") == "with_muzzle"),
-            "without_muzzle": sum(1 for d in detections if d.get("label") == "without_muzzle"),
-        }
+    @staticmethod
+    def make_record(filename, detections, processed_filename, original_image=None,
+                    source=None, **extra):
+        # статистика по изображению (подсчет меток - np.bincount по class_ids)
+        stats = as_detections(detections).stats()
 
         # Создаем новую запись
         record = {
             "timestamp": datetime.now().isoformat(),
             "filename": filename,
+            "original_image": original_image,
             "processed_image": processed_filename,
             "detections": detections,
             "stats": stats
         }
+        if source is not None:
+            record["source"] = source
+        # версия модели, которая дала эти детекции
+        model_version = getattr(detections, 'model_version', None)
+        if model_version is not None:
+            record["model_version"] = model_version
+        record.update(extra)
+        return record
 
-        # Добавляем запись и сохраняем
-        history.append(record)
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=2, ensure_ascii=False)
+    def save_to_history(self, filename, detections, processed_filename, original_image=None,
+                        source=None, **extra):
+        record = self.make_record(filename, detections, processed_filename, original_image, source, **extra)
+        record.setdefault("model_version", self.model_version)
+
+        # Дописываем запись в хранилище и обновляем агрегаты
+        with stages.timer('history_write'):
+            self.history.append(record)
+            self.rollups.update([record])
 
         #print(f"Результат сохранен в историю")
         return record
 
+    def save_many_to_history(self, records):
+        # пакетная запись готовых записей (см. make_record) одной транзакцией.
+        # Время записи - момент фиксации, а не создания: иначе записи пакета оказались бы
+        # старше одиночных загрузок, записанных раньше них, и курсор ?after= их бы пропустил
+        for record in records:
+            record["timestamp"] = datetime.now().isoformat()
+            record.setdefault("model_version", self.model_version)
+        with stages.timer('history_write'):
+            self.history.append_many(records)
+            self.rollups.update(records)
+        return records
+
     def get_history(self, limit=50):
         try:
-            with open(self.history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            return history[-limit:]
+            return self.history.tail(limit)
         except Exception as e:
             print(f"Ошибка загрузки истории: {e}")
             return []
 
+    def render_processed_image(self, processed_filename, folder=UPLOADS_PATH, wait=None):
+        # Изображение с разметкой рисуется лениво, при первом обращении,
+        # по оригиналу и детекциям из истории; дальше отдается готовый файл
+        processed_path = os.path.join(folder, processed_filename)
+        stored = find_stored(processed_path)
+        if stored is not None:
+            return stored
+        record = self.history.find(processed_image=processed_filename)
+        if record is None or not record.get('original_image'):
+            return None
+        if wait is not None:
+            # оригинал может еще записываться в фоне
+            wait(record['original_image'])
+        if not render_to_file(os.path.join(folder, record['original_image']), record['detections'], processed_path):
+            return None
+        return processed_path
+
+    def get_history_page(self, **filters):
+        # страница истории по курсору (см. HistoryStore.page)
+        return self.history.page(**filters)
+
+    def history_version(self):
+        return self.history.version()
+
+    def get_totals(self):
+        # итоги по всей истории (поддерживаются хранилищем при каждой записи)
+        return self.history.totals()
+
+    def get_aggregates(self, granularity='hour', start=None, end=None, source=None, by_source=False):
+        # статистика по окнам времени из предагрегированных счетчиков
+        return self.rollups.query(granularity, start, end, source, by_source)
+
+    def clear_history(self):
+        self.history.clear()
+        self.rollups.clear()
+
     def generate_pdf_report(self):
         from reportlab.lib.pagesizes import letter
         from reportlab.pdfgen import canvas
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        from reportlab.lib.utils import ImageReader
         import os
 
-        history = self.get_history()
+        # для отчета нужны только итоги и последние записи
+        totals = self.get_totals()
+        history = self.get_history(REPORT_RECENT_IMAGES)
         # if not history:
         #     print("История пустая, отчет не сгенерирован")
         #     return None
 
-        # имя файла отчета
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        report_path = f"{REPORTS_PATH}/отчет_детекция_собак_{timestamp}.pdf"
+        # имя файла отчета: микросекунды и pid - отчеты, начатые в одну секунду
+        # (в том числе в разных рабочих процессах), не перезаписывают друг друга
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        report_path = f"{REPORTS_PATH}/отчет_детекция_собак_{timestamp}_{os.getpid()}.pdf"
+        os.makedirs(REPORTS_PATH, exist_ok=True)
 
         try:
             # Создаем PDF
@@ -137,14 +304,7 @@ class MuzzleDetectorModel:
             width, height = letter
 
             # подгрузка шрифта
-            font_name = "RussianFont"
-            font_path = FONT_PATH
-            if os.path.exists(font_path):
-                try:
-                    pdfmetrics.registerFont(TTFont(font_name, font_path))
-                    #print(f"Зарегистрирован шрифт с кириллицей: {font_path}")
-                except Exception as e:
-                    print(f"Не удалось зарегистрировать {font_path}: {e}")
+            font_name = register_report_font()
 
             # ====== СОЗДАНИЕ ОТЧЕТА ======
 
@@ -156,25 +316,17 @@ class MuzzleDetectorModel:
             c.setFont(font_name, 10)
 
             c.drawString(50, height - 80, f"Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            if history:
-                c.drawString(50, height - 100, f"Всего записей в истории: {len(history)}")
-            else:
-                c.drawString(50, height - 100, f"Всего записей в истории: {0}")
+            c.drawString(50, height - 100, f"Всего записей в истории: {totals['records']}")
 
             # Общая статистика
             y_position = height - 140
             c.setFont(font_name, 12)
             c.drawString(50, y_position, "ОБЩАЯ СТАТИСТИКА:")
 
-            # Считаем общую статистику
-            if history:
-                total_dogs = sum(r['stats']['total_dogs'] for r in history)
-                total_with = sum(r['stats']['with_muzzle'] for r in history)
-                total_without = sum(r['stats']['without_muzzle'] for r in history)
-            else:
-                total_dogs = 0
-                total_with = 0
-                total_without = 0
+            # Общая статистика из накопленных итогов
+            total_dogs = totals['total_dogs']
+            total_with = totals['with_muzzle']
+            total_without = totals['without_muzzle']
 
             y_position -= 25
             c.setFont(font_name, 10)
@@ -207,7 +359,7 @@ class MuzzleDetectorModel:
             c.drawString(50, y_position, "ИЗОБРАЖЕНИЯ ПОСЛЕДНИХ ОБНАРУЖЕНИЙ:")
 
             if history:
-                recent_history = history[-10:]  # Последние 10 записей
+                recent_history = history  # Последние 10 записей
 
                 # Константы для изображений
                 IMAGE_WIDTH = 250  # Ширина изображения в PDF
@@ -224,11 +376,14 @@ class MuzzleDetectorModel:
                         y_position = height - 250
                         c.setFont(font_name, 10)
 
-                    # Получаем путь к изображению
-                    image_path = f"./static/uploads/{record['processed_image']}"
+                    # Получаем путь к изображению и его уменьшенной копии
+                    image_path = f"{UPLOADS_PATH}/{record.get('processed_image')}"
+                    if record.get('processed_image'):
+                        image_path = self.render_processed_image(record['processed_image']) or image_path
+                    thumbnail_path = get_thumbnail(image_path) if record.get('processed_image') else None
 
                     # Проверяем существование файла
-                    if os.path.exists(image_path):
+                    if thumbnail_path:
                         try:
                             # Добавляем подпись к изображению
                             timestamp_str = datetime.fromisoformat(record['timestamp']).strftime('%H:%M:%S')
@@ -250,7 +405,7 @@ class MuzzleDetectorModel:
                             c.drawString(70, y_position + IMAGE_HEIGHT + 5, stats_text)
 
                             # Добавляем само изображение
-                            c.drawImage(ImageReader(image_path),
+                            c.drawImage(thumbnail_path,
                                         70,  # X позиция
                                         y_position,  # Y позиция
                                         width=IMAGE_WIDTH,
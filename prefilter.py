@@ -0,0 +1,128 @@
+import threading
+from collections import Counter
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from watched_file import WatchedJsonFile
+
+
+PROFILES_SUFFIX = '.profiles.json'  # профили лежат рядом с весами: <модель>.profiles.json
+PROFILES_RELOAD_INTERVAL = 5.0  # как часто проверять, не изменился ли файл профилей, секунды
+# профиль по умолчанию; в файле - ключ "default" и профили по источникам (камерам):
+# {"default": {"confidence": 0.5}, "cam-1": {"confidence": 0.35, "prefilter": true, "motion_threshold": 3}}
+DEFAULT_PROFILE = {
+    'confidence': None,  # None - общий CONFIDENCE_THRESHOLD
+    'prefilter': False,  # пропускать модель для кадров без движения относительно фона камеры
+    'motion_threshold': 4.0,  # средняя разница яркости с фоном, ниже которой кадр считается пустым
+    'max_skipped': 30,  # после стольких пропусков подряд модель запускается принудительно
+}
+MOTION_SIZE = 64  # размер уменьшенного кадра для сравнения с фоном
+BACKGROUND_ALPHA = 0.05  # скорость обновления фона (скользящее среднее)
+
+
+def profiles_path(model_path):
+    path = Path(model_path)
+    return path.with_name(path.stem + PROFILES_SUFFIX)
+
+
+def _validate_profiles(profiles):
+    if not isinstance(profiles, dict):
+        raise ValueError("ожидается объект {источник: профиль}")
+
+
+class ThresholdProfiles:
+    # Пороги и настройки предфильтра по источникам. Файл перечитывается при изменении,
+    # без перезапуска сервера
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = self._watch(path)
+
+    @staticmethod
+    def _watch(path):
+        return WatchedJsonFile(path, PROFILES_RELOAD_INTERVAL, label="профили порогов",
+                               validate=_validate_profiles)
+
+    @property
+    def path(self):
+        return self._file.path
+
+    def use(self, path):
+        # профили другой модели (после замены весов)
+        with self._lock:
+            self._file = self._watch(path)
+
+    def _profiles(self):
+        with self._lock:
+            self._file.reload()
+            return self._file.data or {}
+
+    def get(self, source=None):
+        profiles = self._profiles()
+        return {**DEFAULT_PROFILE, **profiles.get('default', {}), **profiles.get(source or 'default', {})}
+
+    def all(self):
+        return dict(self._profiles())
+
+
+class MotionPrefilter:
+    # Дешевая проверка перед моделью: уменьшенный кадр сравнивается с фоном источника.
+    # Если сцена не изменилась, возвращаются детекции последнего прогона модели
+    # (неподвижная собака не пропадает из статистики)
+
+    def __init__(self, size=MOTION_SIZE, alpha=BACKGROUND_ALPHA):
+        self.size = size
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._frames = Counter()
+        self._skipped = Counter()
+
+    def _small(self, frame):
+        small = cv2.cvtColor(cv2.resize(frame, (self.size, self.size), interpolation=cv2.INTER_AREA),
+                             cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.float32)
+
+    def check(self, source, frame, profile):
+        # детекции для пропуска модели или None - модель нужно запустить
+        small = self._small(frame)
+        with self._lock:
+            self._frames[source] += 1
+            state = self._sources.get(source)
+            if state is None:
+                self._sources[source] = {'background': small, 'detections': None, 'skipped': 0}
+                return None
+            motion = float(cv2.absdiff(small, state['background']).mean())
+            cv2.accumulateWeighted(small, state['background'], self.alpha)
+            if (motion >= profile['motion_threshold'] or state['detections'] is None
+                    or state['skipped'] >= profile['max_skipped']):
+                return None
+            state['skipped'] += 1
+            self._skipped[source] += 1
+            return state['detections']
+
+    def update(self, source, detections):
+        # результат полного прогона модели - для следующих кадров без движения
+        with self._lock:
+            state = self._sources.get(source)
+            if state is not None:
+                state['detections'] = detections
+                state['skipped'] = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'frames': sum(self._frames.values()),
+                'skipped': sum(self._skipped.values()),
+                'sources': {source: {'frames': count, 'skipped': self._skipped[source]}
+                            for source, count in self._frames.items()},
+            }
+
+    def reset(self, source=None):
+        with self._lock:
+            if source is None:
+                self._sources.clear()
+            else:
+                self._sources.pop(source, None)
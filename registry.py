@@ -0,0 +1,334 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from backends import EXPORTS_PATH
+from detections import iou_matrix
+from jobs import JobManager, QueueFull
+from metrics import summarize
+from watched_file import WatchedJsonFile
+
+
+REGISTRY_PATH = os.path.join(EXPORTS_PATH, "registry.json")
+DEFAULT_VERSION = "default"  # имя версии для MODEL_PATH при первом запуске
+VERSION_NAME_PATTERN = re.compile(r'^[\w.-]{1,64}$')
+SHADOW_SAMPLE_RATE = 0.1  # доля кадров, которые дополнительно прогоняются через модель-кандидата
+SHADOW_MAX_QUEUE = 16  # кадров в очереди кандидата; лишние не ждут, а отбрасываются
+SHADOW_MATCH_IOU = 0.5  # рамки моделей совпадают при том же классе и IoU не ниже порога
+SHADOW_WINDOW = 1000  # по скольким последним сравнениям считаются метрики
+REGISTRY_RELOAD_INTERVAL = 2.0  # как часто проверять, не изменил ли реестр другой процесс, секунды
+
+
+def _validate_registry(data):
+    if not isinstance(data, dict) or not data.get('versions'):
+        raise ValueError("нет версий")
+
+
+class ModelRegistry:
+    # Именованные версии весов в JSON-файле: {"active": имя, "versions": {имя: {"weights": путь, ...}},
+    # "shadow": {"version": имя, "sample_rate": доля} или null}.
+    # Файл общий для рабочих процессов serve.py: перечитывается при изменении (как профили порогов),
+    # перед записью - обязательно
+
+    def __init__(self, path=REGISTRY_PATH, default_weights=None, reload_interval=REGISTRY_RELOAD_INTERVAL):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file = WatchedJsonFile(self.path, reload_interval, label="реестр моделей",
+                                     validate=_validate_registry)
+        self._data = {'active': None, 'versions': {}, 'shadow': None}
+        if default_weights is not None:
+            self._data['versions'][DEFAULT_VERSION] = {'weights': str(default_weights),
+                                                       'added_at': datetime.now().isoformat()}
+            self._data['active'] = DEFAULT_VERSION
+        with self._lock:
+            self._reload(force=True)
+
+    def _reload(self, force=False):
+        # вызывается под self._lock; без файла (удален или еще не создан) остается реестр в памяти
+        if self._file.reload(force) and self._file.data is not None:
+            data = self._file.data
+            data.setdefault('active', None)
+            data.setdefault('shadow', None)
+            self._data = data
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+        self._file.saved(self._data)
+
+    @property
+    def active(self):
+        with self._lock:
+            self._reload()
+            return self._data['active']
+
+    @property
+    def shadow(self):
+        with self._lock:
+            self._reload()
+            return self._data['shadow']
+
+    def weights(self, name):
+        with self._lock:
+            # версию могли только что добавить в другом процессе
+            self._reload(force=name not in self._data['versions'])
+            version = self._data['versions'].get(name)
+        if version is None:
+            raise KeyError(f"Нет версии модели: {name}")
+        return version['weights']
+
+    def add(self, name, weights):
+        if not VERSION_NAME_PATTERN.match(name or ''):
+            raise ValueError("Имя версии: буквы, цифры, '.', '-', '_' (до 64 символов)")
+        # веса загружаются через unpickling torch - только файлы из папки моделей
+        # (после разрешения '..' и символических ссылок)
+        models_dir = Path(EXPORTS_PATH).resolve()
+        if models_dir not in Path(weights).resolve().parents:
+            raise ValueError(f"Файл весов должен лежать в папке {EXPORTS_PATH}")
+        if not Path(weights).is_file():
+            raise FileNotFoundError(f"Нет файла весов: {weights}")
+        with self._lock:
+            self._reload(force=True)
+            self._data['versions'][name] = {'weights': str(weights), 'added_at': datetime.now().isoformat()}
+            self._save()
+
+    def remove(self, name):
+        with self._lock:
+            self._reload(force=True)
+            shadow = self._data['shadow'] or {}
+            if name in (self._data['active'], shadow.get('version')):
+                raise ValueError(f"Версия {name} используется")
+            if self._data['versions'].pop(name, None) is None:
+                raise KeyError(f"Нет версии модели: {name}")
+            self._save()
+
+    def set_active(self, name):
+        with self._lock:
+            self._reload(force=True)
+            self._data['active'] = name
+            self._save()
+
+    def set_shadow(self, name, sample_rate=None):
+        with self._lock:
+            self._reload(force=True)
+            self._data['shadow'] = {'version': name, 'sample_rate': sample_rate} if name else None
+            self._save()
+
+    def to_dict(self):
+        with self._lock:
+            self._reload()
+            return json.loads(json.dumps(self._data))
+
+
+def detection_agreement(primary, candidate, match_iou=SHADOW_MATCH_IOU):
+    # доля совпавших рамок среди рамок обеих моделей (1.0 - обе ничего не нашли)
+    if not len(primary) and not len(candidate):
+        return 1.0
+    if not len(primary) or not len(candidate):
+        return 0.0
+    ious = iou_matrix(primary.boxes, candidate.boxes)
+    ious[primary.class_ids[:, None] != candidate.class_ids[None, :]] = 0
+    used_primary, used_candidate = set(), set()
+    # жадное сопоставление по убыванию IoU
+    for flat in np.argsort(-ious, axis=None):
+        p, c = np.unravel_index(flat, ious.shape)
+        if ious[p, c] < match_iou:
+            break
+        if p not in used_primary and c not in used_candidate:
+            used_primary.add(p)
+            used_candidate.add(c)
+    return 2 * len(used_primary) / (len(primary) + len(candidate))
+
+
+class ShadowEvaluator:
+    # A/B в тени: выборка кадров основной модели прогоняется через кандидата в отдельном потоке.
+    # Ответы и история не меняются; копятся задержки обеих моделей и согласие детекций
+
+    def __init__(self, candidate, version, sample_rate=SHADOW_SAMPLE_RATE, match_iou=SHADOW_MATCH_IOU,
+                 max_queue=SHADOW_MAX_QUEUE, window=SHADOW_WINDOW):
+        self.candidate = candidate
+        self.version = version
+        self.sample_rate = sample_rate
+        self.match_iou = match_iou
+        self._jobs = JobManager(workers=1, max_queue=max_queue, max_jobs_kept=0, name='shadow')
+        self._lock = threading.Lock()
+        self._agreement = deque(maxlen=window)
+        self._same_stats = deque(maxlen=window)
+        self._primary_ms = deque(maxlen=window)
+        self._candidate_ms = deque(maxlen=window)
+        self.sampled = 0
+        self.dropped = 0
+
+    def submit(self, frames, detections, confidence_threshold, primary_ms):
+        for frame, primary in zip(frames, detections):
+            if random.random() >= self.sample_rate:
+                continue
+            try:
+                self._jobs.submit(self._compare, frame, primary, confidence_threshold, primary_ms, kind='shadow')
+            except QueueFull:
+                # кандидат не успевает - кадр не сравниваем, основной путь не ждет
+                with self._lock:
+                    self.dropped += 1
+                continue
+            with self._lock:
+                self.sampled += 1
+
+    def _compare(self, frame, primary, confidence_threshold, primary_ms):
+        started = time.perf_counter()
+        candidate, _ = self.candidate.predict_batch([frame], confidence_threshold, render=False)[0]
+        candidate_ms = (time.perf_counter() - started) * 1000
+        agreement = detection_agreement(primary, candidate, self.match_iou)
+        with self._lock:
+            self._agreement.append(agreement)
+            self._same_stats.append(primary.stats() == candidate.stats())
+            self._primary_ms.append(primary_ms)
+            self._candidate_ms.append(candidate_ms)
+
+    def stats(self):
+        with self._lock:
+            compared = len(self._agreement)
+            return {
+                'version': self.version,
+                'model_version': self.candidate.model_version,
+                'sample_rate': self.sample_rate,
+                'sampled': self.sampled,
+                'dropped': self.dropped,
+                'compared': compared,
+                # среднее согласие рамок и доля кадров с одинаковыми счетчиками по меткам
+                'agreement': round(sum(self._agreement) / compared, 4) if compared else None,
+                'stats_match_rate': round(sum(self._same_stats) / compared, 4) if compared else None,
+                'primary_latency_ms': summarize(self._primary_ms),
+                'candidate_latency_ms': summarize(self._candidate_ms),
+            }
+
+    def stop(self):
+        # кадры, ждущие сравнения, отбрасываются
+        self._jobs.shutdown(wait=False, cancel=True)
+
+
+class ModelManager:
+    # Версии из реестра загружаются и прогреваются в фоне, затем подменяются одним присваиванием
+    # (MuzzleDetectorModel.adopt) - запросы не прерываются. Одна загрузка за раз.
+    # Реестр - источник истины для всех рабочих процессов: каждый процесс сам догоняет
+    # активную и теневую версии из него (sync), а не только тот, что принял запрос
+
+    def __init__(self, registry, get_detector, load_model, on_swap=None, store=None):
+        self.registry = registry
+        self.get_detector = get_detector
+        self.load_model = load_model
+        self.on_swap = on_swap
+        self.jobs = JobManager(workers=1, name='models', store=store)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._current = None
+        self._synced = None  # последнее действие sync (повторно не запускается, если не удалось)
+
+    def _submit(self, fn, *args, kind=None, sync_action=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                # задачи родителя после fork() в этом процессе не выполнятся
+                self._pid = os.getpid()
+                self._current = None
+            # пока предыдущая версия загружается, новая не принимается (QueueFull -> 409)
+            if self._current is not None and self._current.status in ('queued', 'running'):
+                raise QueueFull(f"Уже загружается модель ({self._current.kind})")
+            self._current = self.jobs.submit(fn, *args, kind=kind)
+            self._synced = sync_action
+            return self._current
+
+    def activate(self, name, sync_action=None):
+        weights = self.registry.weights(name)
+        return self._submit(self._activate, name, weights, kind='activate', sync_action=sync_action)
+
+    def _activate(self, name, weights):
+        candidate = self.load_model(weights)
+        detector = self.get_detector()
+        detector.adopt(candidate)
+        if self.registry.active != name:
+            # остальные процессы подхватят версию из реестра
+            self.registry.set_active(name)
+        shadow = detector.shadow
+        if shadow is not None and shadow.version == name:
+            # кандидат стал основной моделью - сравнивать больше не с чем
+            self.clear_shadow()
+        if self.on_swap is not None:
+            self.on_swap(name, weights)
+        return {'active': name, 'model_version': detector.model_version}
+
+    def start_shadow(self, name, sample_rate=SHADOW_SAMPLE_RATE, sync_action=None):
+        weights = self.registry.weights(name)
+        return self._submit(self._start_shadow, name, weights, sample_rate, kind='shadow', sync_action=sync_action)
+
+    def _start_shadow(self, name, weights, sample_rate):
+        candidate = self.load_model(weights)
+        detector = self.get_detector()
+        previous, detector.shadow = detector.shadow, ShadowEvaluator(candidate, name, sample_rate)
+        if previous is not None:
+            previous.stop()
+        if self.registry.shadow != {'version': name, 'sample_rate': sample_rate}:
+            self.registry.set_shadow(name, sample_rate)
+        return {'shadow': name, 'model_version': candidate.model_version}
+
+    def clear_shadow(self, persist=True):
+        detector = self.get_detector()
+        previous, detector.shadow = detector.shadow, None
+        if previous is not None:
+            previous.stop()
+        if persist and self.registry.shadow is not None:
+            self.registry.set_shadow(None)
+
+    def sync(self):
+        # Привести модель этого процесса к реестру: активную версию или теневую мог сменить
+        # другой рабочий процесс. Дешево - реестр перечитывается не чаще REGISTRY_RELOAD_INTERVAL;
+        # загрузка идет в фоне, до ее окончания запросы обслуживает прежняя модель
+        detector = self.get_detector()
+        active, shadow = self.registry.active, self.registry.shadow
+        try:
+            weights = self.registry.weights(active)
+        except KeyError:
+            return
+        local = detector.shadow
+        local_shadow = (local.version, local.sample_rate) if local is not None else None
+        wanted_shadow = (shadow['version'], shadow.get('sample_rate') or SHADOW_SAMPLE_RATE) if shadow else None
+        if detector.model_path != weights:
+            action = ('activate', active, weights)
+        elif local_shadow != wanted_shadow:
+            action = ('shadow', wanted_shadow)
+        else:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._synced == action:
+                # уже выполняется или не удалось - ждем следующего изменения реестра
+                return
+        try:
+            if action[0] == 'activate':
+                self.activate(active, sync_action=action)
+            elif wanted_shadow is None:
+                self.clear_shadow(persist=False)
+            else:
+                self.start_shadow(*wanted_shadow, sync_action=action)
+        except (KeyError, QueueFull):
+            pass
+
+    def status(self):
+        detector = self.get_detector()
+        shadow = detector.shadow
+        return {
+            **self.registry.to_dict(),
+            # модель этого рабочего процесса (после смены версии остальные догоняют реестр в фоне)
+            'model_version': detector.model_version,
+            'weights': detector.model_path,
+            'pid': os.getpid(),
+            'shadow_stats': shadow.stats() if shadow is not None else None,
+        }
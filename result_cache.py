@@ -0,0 +1,114 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from db import LocalConnection
+
+
+CACHE_DB = "cache.db"
+CACHE_MAX_ENTRIES = 1024  # записей в памяти
+CACHE_DISK_MAX_ENTRIES = 100000  # записей на диске
+EVICT_CHECK_EVERY = 100  # как часто проверять размер дискового уровня
+
+
+class ResultCache:
+    # Кэш результатов детекции по хэшу содержимого изображения.
+    # Два уровня: LRU в памяти и SQLite-таблица на диске (переживает перезапуск).
+    # В ключ входят версия модели и порог уверенности, поэтому после смены
+    # весов или порога старые записи просто перестают находиться
+
+    def __init__(self, path=CACHE_DB, max_entries=CACHE_MAX_ENTRIES,
+                 disk_max_entries=CACHE_DISK_MAX_ENTRIES):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = LocalConnection(self.path)
+        self._puts = 0
+        self._counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._db.get().executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache(last_access);
+        """)
+
+
+    @staticmethod
+    def make_key(data, model_version, confidence_threshold):
+        h = hashlib.sha256(data)
+        h.update(f"|{model_version}|{confidence_threshold}".encode('utf-8'))
+        return h.hexdigest()
+
+    def _remember(self, key, value):
+        # кладет запись в LRU в памяти (вызывается под self._lock)
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return value
+
+        conn = self._db.get()
+        row = conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+
+        conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        value = json.loads(row[0])
+        with self._lock:
+            self._counters['disk_hits'] += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            self._puts += 1
+            check = self._puts % EVICT_CHECK_EVERY == 0
+
+        conn = self._db.get()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, last_access) VALUES (?, ?, ?)",
+                     (key, json.dumps(value, ensure_ascii=False), time.time()))
+        if check:
+            self._evict_disk(conn)
+
+    def _evict_disk(self, conn):
+        # вытесняем с диска давно не запрашиваемые записи
+        excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.disk_max_entries
+        if excess > 0:
+            conn.execute("DELETE FROM cache WHERE key IN "
+                         "(SELECT key FROM cache ORDER BY last_access LIMIT ?)", (excess,))
+            with self._lock:
+                self._counters['evictions'] += excess
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self._db.get().execute("DELETE FROM cache")
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['memory_entries'] = len(self._memory)
+        hits = counters['memory_hits'] + counters['disk_hits']
+        total = hits + counters['misses']
+        counters['hits'] = hits
+        counters['hit_rate'] = round(hits / total, 4) if total else 0.0
+        counters['disk_entries'] = self._db.get().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return counters
@@ -0,0 +1,145 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from db import LocalConnection
+
+
+ROLLUPS_DB = "rollups.db"
+# размеры окон агрегации в секундах; можно добавить свои (например, '15min': 900)
+ROLLUP_GRANULARITIES = {'hour': 3600, 'day': 86400}
+DEFAULT_SOURCE = 'upload'
+# skipped - кадры, для которых модель не запускалась (см. prefilter.py)
+COUNTERS = ('images', 'total_dogs', 'with_muzzle', 'without_muzzle', 'skipped')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(timestamp, seconds):
+    # начало окна для локального ISO-времени записи
+    dt = datetime.fromisoformat(timestamp)
+    offset = int((dt.replace(tzinfo=None) - _EPOCH).total_seconds()) // seconds * seconds
+    return (_EPOCH + timedelta(seconds=offset)).isoformat()
+
+
+class RollupStore:
+    # Предагрегированные счетчики по окнам времени и источникам.
+    # Обновляются при каждой записи в историю, поэтому запрос статистики
+    # читает только нужные окна и не зависит от размера истории
+
+    def __init__(self, path=ROLLUPS_DB, granularities=None):
+        self.path = str(path)
+        self.granularities = dict(granularities or ROLLUP_GRANULARITIES)
+        self._db = LocalConnection(self.path)
+        self._db.get().executescript("""
+            CREATE TABLE IF NOT EXISTS rollups (
+                granularity TEXT NOT NULL,
+                source TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                images INTEGER NOT NULL DEFAULT 0,
+                total_dogs INTEGER NOT NULL DEFAULT 0,
+                with_muzzle INTEGER NOT NULL DEFAULT 0,
+                without_muzzle INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (granularity, source, bucket_start)
+            );
+            CREATE INDEX IF NOT EXISTS idx_rollups_bucket ON rollups(granularity, bucket_start);
+        """)
+        # базы до появления счетчика пропущенных кадров
+        if 'skipped' not in {row[1] for row in self._db.get().execute("PRAGMA table_info(rollups)")}:
+            self._db.get().execute("ALTER TABLE rollups ADD COLUMN skipped INTEGER NOT NULL DEFAULT 0")
+
+
+    def update(self, records):
+        # сначала суммируем пачку в памяти, затем одна транзакция на пачку
+        deltas = defaultdict(lambda: [0] * len(COUNTERS))
+        for record in records:
+            stats = record.get('stats', {})
+            values = (1, stats.get('total_dogs', 0), stats.get('with_muzzle', 0), stats.get('without_muzzle', 0),
+                      1 if record.get('prefilter_skipped') else 0)
+            source = record.get('source') or DEFAULT_SOURCE
+            for name, seconds in self.granularities.items():
+                delta = deltas[(name, source, bucket_start(record['timestamp'], seconds))]
+                for i, value in enumerate(values):
+                    delta[i] += value
+        if not deltas:
+            return
+
+        conn = self._db.get()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO rollups (granularity, source, bucket_start, images, total_dogs, with_muzzle, "
+                "without_muzzle, skipped) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (granularity, source, bucket_start) DO UPDATE SET "
+                "images = images + excluded.images, total_dogs = total_dogs + excluded.total_dogs, "
+                "with_muzzle = with_muzzle + excluded.with_muzzle, "
+                "without_muzzle = without_muzzle + excluded.without_muzzle, skipped = skipped + excluded.skipped",
+                [(*key, *values) for key, values in deltas.items()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def query(self, granularity='hour', start=None, end=None, source=None, by_source=False):
+        if granularity not in self.granularities:
+            raise ValueError(f"Неизвестный размер окна: {granularity}")
+
+        group = "bucket_start, source" if by_source else "bucket_start"
+        query = (f"SELECT {group}, SUM(images), SUM(total_dogs), SUM(with_muzzle), SUM(without_muzzle), "
+                 f"SUM(skipped) FROM rollups WHERE granularity = ?")
+        params = [granularity]
+        if start is not None:
+            # окно, в которое попадает start, тоже включаем
+            query += " AND bucket_start >= ?"
+            params.append(bucket_start(start, self.granularities[granularity]))
+        if end is not None:
+            query += " AND bucket_start < ?"
+            params.append(end)
+        if source is not None:
+            query += " AND source = ?"
+            params.append(source)
+        query += f" GROUP BY {group} ORDER BY {group}"
+
+        buckets = []
+        for row in self._db.get().execute(query, params):
+            keys = ('bucket_start', 'source') if by_source else ('bucket_start',)
+            bucket = dict(zip(keys + COUNTERS, row))
+            dogs = bucket['total_dogs']
+            # доля собак в намордниках среди обнаруженных
+            bucket['compliance_rate'] = round(bucket['with_muzzle'] / dogs, 4) if dogs else None
+            buckets.append(bucket)
+        return buckets
+
+    def empty(self):
+        return self._db.get().execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is None
+
+    def sources(self):
+        return [row[0] for row in self._db.get().execute("SELECT DISTINCT source FROM rollups ORDER BY source")]
+
+    def clear(self):
+        self._db.get().execute("DELETE FROM rollups")
+
+    def rebuild(self, history, batch_size=5000):
+        # полный пересчет по истории (после смены набора окон или для старых записей)
+        self.clear()
+        records = []
+        for record in history.range():
+            records.append(record)
+            if len(records) >= batch_size:
+                self.update(records)
+                records = []
+        self.update(records)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from history_store import HISTORY_BACKEND, create_history_store
+
+    parser = argparse.ArgumentParser(description="Пересчет агрегатов статистики по истории")
+    parser.add_argument('--backend', default=HISTORY_BACKEND, choices=['sqlite', 'jsonl'])
+    parser.add_argument('--path', default=None)
+    args = parser.parse_args()
+
+    RollupStore().rebuild(create_history_store(args.backend, args.path))
+    print("Агрегаты пересчитаны")
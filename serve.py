@@ -0,0 +1,134 @@
+import os
+import signal
+import sys
+import threading
+import time
+
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 2))  # процессов (у каждого своя копия модели)
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))  # потоков на процесс (делят одну модель)
+DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', 30))  # сколько ждать завершения запросов при остановке
+REQUEST_TIMEOUT = 120
+
+
+def _drain():
+    # дожидаемся кадров в очереди инференса, фоновой записи файлов и отчетов
+    import main
+
+    main.uploads.stop()
+    # загрузку новой версии модели не ждем - при следующем запуске версия берется из реестра
+    main.models.jobs.shutdown(wait=False, cancel=True)
+    # асинхронные загрузки ставят кадры в очередь инференса - дожидаемся их первыми
+    main.upload_jobs.shutdown(wait=True, timeout=DRAIN_TIMEOUT)
+    main.inference_queue.shutdown(wait=True)
+    main.writer.shutdown(wait=True)
+    main.report_jobs.shutdown(wait=True, timeout=DRAIN_TIMEOUT)
+
+
+def _set_torch_threads(workers):
+    # ядра делятся между процессами, иначе потоки torch мешают друг другу
+    import torch
+
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def run_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"{host}:{port}",
+                'workers': workers,
+                'threads': threads,
+                'worker_class': 'gthread',
+                # модель загружается один раз в мастере до fork()
+                'preload_app': True,
+                'timeout': REQUEST_TIMEOUT,
+                'graceful_timeout': DRAIN_TIMEOUT,
+                'post_fork': lambda server, worker: _set_torch_threads(workers),
+                'worker_exit': lambda server, worker: _drain(),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from main import app, detector
+            # с preload_app модель загружается и прогревается в мастере до fork()
+            detector.get(timeout=None)
+            return app
+
+    Server().run()
+
+
+def run_waitress(host, port, threads):
+    # Windows: один процесс, потоки делят модель
+    from waitress import create_server, wasyncore
+    from main import app
+
+    server = create_server(app, host=host, port=port, threads=threads)
+
+    def finish():
+        # ждем, пока обработаются принятые запросы, затем закрываем соединения
+        dispatcher = server.task_dispatcher
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline and (dispatcher.active_count or dispatcher.queue):
+            time.sleep(0.1)
+        time.sleep(0.5)  # даем отправить последние ответы
+        server.trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+
+    def stop(signum, frame):
+        print("Остановка сервера: новые соединения не принимаются, ждем текущие запросы...")
+        # сокеты закрываются только внутри цикла событий waitress
+        server.trigger.pull_trigger(lambda: wasyncore.dispatcher.close(server))
+        threading.Thread(target=finish, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.run()
+    finally:
+        server.task_dispatcher.shutdown(cancel_pending=False, timeout=DRAIN_TIMEOUT)
+        _drain()
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, threads=SERVER_THREADS):
+    try:
+        import gunicorn  # noqa: F401
+        use_gunicorn = sys.platform != 'win32'
+    except ImportError:
+        use_gunicorn = False
+
+    if use_gunicorn:
+        print(f"Запуск gunicorn: {workers} процессов x {threads} потоков на {host}:{port}")
+        run_gunicorn(host, port, workers, threads)
+    else:
+        print(f"Запуск waitress: {threads} потоков на {host}:{port}")
+        run_waitress(host, port, threads)
+
+
+def load_test(url, image_path, levels=(1, 2, 4, 8, 16), requests_per_level=64):
+    # пропускная способность /upload при разном числе одновременных клиентов (см. benchmark.py)
+    from benchmark import print_rows, run_http
+
+    print_rows(run_http(url, [image_path], levels, requests_per_level))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Продакшен-сервер детектора")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS)
+    parser.add_argument('--load-test', metavar='IMAGE', help="замерить пропускную способность запущенного сервера")
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    if args.load_test:
+        load_test(f"http://127.0.0.1:{args.port}/upload", args.load_test, args.levels)
+    else:
+        serve(args.host, args.port, args.workers, args.threads)
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+
+# момент начала импорта приложения (main импортирует этот модуль первым)
+STARTED_AT = time.perf_counter()
+
+BACKGROUND_LOAD = True  # загружать модель в фоне: сервер сразу отвечает на /healthz, /readyz - после прогрева
+WARMUP_RUNS = 2  # прогонов синтетического кадра перед готовностью (первый прогон инициализирует граф)
+WARMUP_SIZE = (640, 640)  # (ширина, высота) синтетического кадра
+MODEL_WAIT_TIMEOUT = 60  # сколько запрос ждет загрузки модели, секунды
+
+
+class ModelNotReady(RuntimeError):
+    pass
+
+
+def _since(started):
+    return round(time.perf_counter() - started, 3)
+
+
+def warm_up(detector, runs=WARMUP_RUNS, size=WARMUP_SIZE):
+    # прогон синтетического кадра: ленивая инициализация графа и буферов
+    # происходит здесь, а не на первом запросе пользователя.
+    # Возвращает (время первого прогона, время всех прогонов), секунды
+    import numpy as np
+
+    width, height = size
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    started = time.perf_counter()
+    first = None
+    for _ in range(runs):
+        detector.predict_batch([frame], render=False)
+        if first is None:
+            first = _since(started)
+    return first, _since(started)
+
+
+class DetectorLoader:
+    # Загрузка и прогрев детектора вне пути запроса. Пока модель не готова,
+    # обращение к атрибутам ждет ее не дольше MODEL_WAIT_TIMEOUT и бросает ModelNotReady
+
+    def __init__(self, factory, warmup_runs=WARMUP_RUNS, warmup_size=WARMUP_SIZE, on_ready=None):
+        self._factory = factory
+        self._warmup_runs = warmup_runs
+        self._warmup_size = warmup_size
+        self._on_ready = on_ready
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._detector = None
+        self._error = None
+        self.state = 'pending'
+        self.timings = {}
+
+    def start(self, background=BACKGROUND_LOAD):
+        with self._lock:
+            # после fork() поток загрузки остался в родителе - запускаем заново
+            if self._pid == os.getpid() or self._ready.is_set():
+                return self
+            self._pid = os.getpid()
+            self.timings['import_sec'] = _since(STARTED_AT)
+            if background:
+                self._thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+                self._thread.start()
+        if not background:
+            self._load()
+        return self
+
+    def _load(self):
+        try:
+            self.state = 'loading'
+            started = time.perf_counter()
+            detector = self._factory()
+            self.timings['load_sec'] = _since(started)
+
+            self.state = 'warming_up'
+            self._warmup(detector)
+            self._detector = detector
+            self.state = 'ready'
+            self.timings['ready_sec'] = _since(STARTED_AT)
+            print(f"Модель готова: импорт {self.timings['import_sec']} с, загрузка {self.timings['load_sec']} с, "
+                  f"первый прогон {self.timings.get('first_prediction_sec')} с, "
+                  f"всего {self.timings['ready_sec']} с")
+            if self._on_ready is not None:
+                self._on_ready(detector)
+        except Exception as e:
+            self._error = e
+            self.state = 'failed'
+            print(f"Ошибка загрузки модели: {e}")
+        finally:
+            self._ready.set()
+
+    def _warmup(self, detector):
+        first, total = warm_up(detector, self._warmup_runs, self._warmup_size)
+        self.timings['first_prediction_sec'] = first
+        self.timings['warmup_sec'] = total
+
+        # свернутая модель сохраняется для следующих запусков
+        try:
+            cached = detector.cache_fused_model()
+            if cached:
+                print(f"Свернутая модель сохранена: {cached}")
+        except Exception as e:
+            print(f"Не удалось сохранить свернутую модель: {e}")
+
+    @property
+    def ready(self):
+        return self._detector is not None
+
+    def get(self, timeout=MODEL_WAIT_TIMEOUT):
+        if self._detector is not None:
+            return self._detector
+        self.start()
+        if not self._ready.wait(timeout):
+            raise ModelNotReady(f"Модель еще загружается ({self.state})")
+        if self._detector is None:
+            raise ModelNotReady(f"Модель не загружена: {self._error}")
+        return self._detector
+
+    def status(self):
+        return {'state': self.state, 'ready': self.ready, 'timings': dict(self.timings),
+                'error': str(self._error) if self._error else None}
+
+    def __getattr__(self, name):
+        # detector.predict_batch(...), detector.history и т.д. - от загруженной модели
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+if __name__ == "__main__":
+    # замер холодного старта: импорт main, загрузка и прогрев модели
+    import main
+
+    try:
+        main.detector.get(timeout=None)
+    except ModelNotReady:
+        pass
+    status = main.detector.status()
+    for key, value in status['timings'].items():
+        print(f"{key:<22} {value} с")
+    if status['error']:
+        print(f"Ошибка: {status['error']}")
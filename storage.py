@@ -0,0 +1,351 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import cv2
+from werkzeug.security import safe_join
+
+from metrics import stages
+
+
+WRITER_THREADS = 2
+WRITE_WAIT_TIMEOUT = 10  # сколько секунд GET ждет незавершенную запись файла
+THUMBNAILS_FOLDER = 'static/thumbnails'
+THUMBNAIL_SIZE = (500, 360)  # с запасом для вставки 250x180 pt в PDF
+THUMBNAIL_QUALITY = 80
+
+UPLOAD_FOLDER = 'static/uploads'
+SHARD_FORMAT = '%Y/%m/%d/%H'  # файлы раскладываются по подпапкам год/месяц/день/час
+RETENTION_DAYS = 30  # сколько дней хранить загрузки (None - без ограничения)
+RETENTION_MAX_BYTES = 10 * 1024 ** 3  # предельный объем папки загрузок (None - без ограничения)
+RECOMPRESS_AFTER_DAYS = 3  # через сколько дней пережимать обработанные изображения (None - не пережимать)
+RECOMPRESS_FORMAT = 'webp'  # 'webp' или 'jpeg'
+RECOMPRESS_QUALITY = 75
+RECOMPRESSED_EXTENSIONS = {'webp': '.webp', 'jpeg': '.jpg'}
+CLEANUP_INTERVAL = 3600  # период фоновой очистки в секундах
+CLEANUP_DELAY = 60  # первая очистка - через минуту после старта
+SHARD_MARGIN = timedelta(minutes=1)  # запас на расхождение времени записи в истории и имени файла
+
+
+class BackgroundWriter:
+    # Фоновая запись загруженных и обработанных изображений на диск,
+    # чтобы кодирование и запись не задерживали ответ на /upload
+
+    def __init__(self, max_workers=WRITER_THREADS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # пул создается лениво и пересоздается после fork()
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = {}
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='writer')
+            return self._executor
+
+    def _submit(self, path, fn, *args):
+        executor = self._get_executor()
+        key = os.path.basename(path)
+        with self._lock:
+            future = executor.submit(fn, path, *args)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    @staticmethod
+    def _write_bytes(path, data):
+        with stages.timer('file_write'):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    @staticmethod
+    def _write_image(path, image):
+        with stages.timer('encode'):
+            if not cv2.imwrite(path, image):
+                print(f"Не удалось сохранить изображение: {path}")
+
+    def write_bytes(self, path, data):
+        return self._submit(path, self._write_bytes, data)
+
+    def write_image(self, path, image):
+        return self._submit(path, self._write_image, image)
+
+    def wait(self, filename, timeout=WRITE_WAIT_TIMEOUT):
+        # дождаться записи файла, если она еще не закончилась
+        with self._lock:
+            future = self._pending.get(os.path.basename(filename))
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception as e:
+                print(f"Ошибка записи файла {filename}: {e}")
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+def get_thumbnail(image_path, size=THUMBNAIL_SIZE, folder=THUMBNAILS_FOLDER):
+    # Уменьшенная копия изображения; создается один раз и переиспользуется,
+    # пока исходный файл не изменится
+    if not os.path.exists(image_path):
+        return None
+    width, height = size
+    thumbnail_path = os.path.join(folder, f"{Path(image_path).stem}_{width}x{height}.jpg")
+    if os.path.exists(thumbnail_path) and os.path.getmtime(thumbnail_path) >= os.path.getmtime(image_path):
+        return thumbnail_path
+
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
+    scale = min(width / img.shape[1], height / img.shape[0], 1.0)
+    if scale < 1.0:
+        img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.jpg"
+    cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+    os.replace(tmp_path, thumbnail_path)
+    return thumbnail_path
+
+
+def find_stored(path):
+    # путь к файлу или к его пережатой копии (после recompress меняется расширение)
+    if os.path.isfile(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    for variant in RECOMPRESSED_EXTENSIONS.values():
+        if variant != ext.lower() and os.path.isfile(stem + variant):
+            return stem + variant
+    return None
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class UploadStorage:
+    # Папка загрузок с разбиением по часам, сроком хранения и пережатием старых файлов.
+    # Имена файлов в истории - относительные пути вида 2024/05/01/13/processed_....jpg.
+    # Очистка идет в фоне: сначала история перестает ссылаться на файлы старше
+    # срока (HistoryStore.expire_files), затем удаляются целые часовые папки
+
+    def __init__(self, root=UPLOAD_FOLDER, thumbnails=THUMBNAILS_FOLDER, retention_days=RETENTION_DAYS,
+                 max_bytes=RETENTION_MAX_BYTES, recompress_after_days=RECOMPRESS_AFTER_DAYS,
+                 recompress_format=RECOMPRESS_FORMAT, quality=RECOMPRESS_QUALITY):
+        self.root = root
+        self.thumbnails = thumbnails
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.recompress_after_days = recompress_after_days
+        self.recompress_format = recompress_format
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        os.makedirs(root, exist_ok=True)
+
+    def new_name(self, prefix, filename, now=None):
+        # уникальное имя в папке текущего часа (папка создается сразу)
+        now = now or datetime.now()
+        shard = now.strftime(SHARD_FORMAT)
+        os.makedirs(os.path.join(self.root, shard), exist_ok=True)
+        return f"{shard}/{prefix}_{now.strftime('%Y%m%d_%H%M%S_%f')}_{filename}"
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def resolve(self, name):
+        # относительное имя существующего файла (возможно, пережатого) или None
+        path = safe_join(self.root, name)
+        found = find_stored(path) if path else None
+        if found is None:
+            return None
+        return name[:len(name) - len(os.path.splitext(name)[1])] + os.path.splitext(found)[1]
+
+    def _shards(self):
+        # часовые папки (начало часа, путь) от старых к новым
+        shards = []
+        for dirpath, dirnames, _ in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            if rel.count('/') == 3:
+                dirnames[:] = []
+                try:
+                    shards.append((datetime.strptime(rel, SHARD_FORMAT), dirpath))
+                except ValueError:
+                    pass
+        return sorted(shards)
+
+    def cleanup(self, history=None, now=None):
+        now = now or datetime.now()
+        shards = self._shards()
+        report = {'removed_files': 0, 'removed_bytes': 0, 'recompressed': 0, 'saved_bytes': 0, 'cutoff': None}
+
+        # граница удаления: по возрасту и по объему (удаляются самые старые часы).
+        # Текущий час не удаляется никогда: в его папку еще пишутся файлы, а в историю - записи
+        current = now.replace(minute=0, second=0, microsecond=0)
+        cutoff = now - timedelta(days=self.retention_days) if self.retention_days is not None else None
+        if self.max_bytes is not None:
+            sizes = [(start, _tree_size(path)) for start, path in shards]
+            total = sum(size for _, size in sizes)
+            for start, size in sizes:
+                if total <= self.max_bytes or start >= current:
+                    break
+                total -= size
+                end = start + timedelta(hours=1)
+                cutoff = end if cutoff is None or end > cutoff else cutoff
+
+        if cutoff is not None:
+            cutoff = min(cutoff, current)
+            report['cutoff'] = cutoff.isoformat()
+            if history is not None:
+                history.expire_files(min(cutoff + SHARD_MARGIN, current).isoformat())
+            for start, path in shards:
+                if start + timedelta(hours=1) > cutoff:
+                    break
+                size = _tree_size(path)
+                files = sum(len(f) for _, _, f in os.walk(path))
+                shutil.rmtree(path, ignore_errors=True)
+                report['removed_files'] += files
+                report['removed_bytes'] += size
+            # файлы в корне (сохраненные до разбиения по папкам) и миниатюры - по времени изменения
+            for folder in (self.root, self.thumbnails):
+                if not os.path.isdir(folder):
+                    continue
+                for entry in os.scandir(folder):
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff.timestamp():
+                            size = entry.stat().st_size
+                            os.unlink(entry.path)
+                            report['removed_files'] += 1
+                            report['removed_bytes'] += size
+                    except OSError:
+                        pass
+            self._remove_empty_dirs()
+
+        if self.recompress_after_days is not None:
+            threshold = now - timedelta(days=self.recompress_after_days)
+            for start, path in shards:
+                if start + timedelta(hours=1) > threshold:
+                    break
+                if os.path.isdir(path):
+                    for count, saved in self._recompress_dir(path):
+                        report['recompressed'] += count
+                        report['saved_bytes'] += saved
+
+        self._remove_trash()
+        return report
+
+    def _recompress_dir(self, path):
+        # обработанные изображения пережимаются в меньший формат, исходный файл удаляется
+        target_ext = RECOMPRESSED_EXTENSIONS[self.recompress_format]
+        flag = cv2.IMWRITE_WEBP_QUALITY if self.recompress_format == 'webp' else cv2.IMWRITE_JPEG_QUALITY
+        for entry in os.scandir(path):
+            stem, ext = os.path.splitext(entry.name)
+            if not entry.name.startswith('processed_') or ext.lower() == target_ext:
+                continue
+            img = cv2.imread(entry.path)
+            if img is None:
+                continue
+            target = os.path.join(path, stem + target_ext)
+            tmp = f"{target}.{os.getpid()}{target_ext}"
+            if not cv2.imwrite(tmp, img, [flag, self.quality]):
+                continue
+            size = entry.stat().st_size
+            os.replace(tmp, target)
+            os.unlink(entry.path)
+            yield 1, size - os.path.getsize(target)
+
+    def _remove_empty_dirs(self):
+        for dirpath, _, _ in os.walk(self.root, topdown=False):
+            if dirpath != self.root:
+                try:
+                    os.rmdir(dirpath)  # удаляется, только если папка пуста
+                except OSError:
+                    pass
+
+    def _remove_trash(self):
+        # остатки clear(), не удаленные из-за перезапуска
+        for folder in (self.root, self.thumbnails):
+            parent = os.path.dirname(os.path.abspath(folder))
+            prefix = os.path.basename(os.path.abspath(folder)) + '.deleted-'
+            for entry in os.scandir(parent):
+                if entry.name.startswith(prefix) and entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+    def clear(self):
+        # Папки переименовываются (мгновенно), удаление содержимого идет в фоне
+        trash = []
+        for folder in (self.root, self.thumbnails):
+            if os.path.isdir(folder):
+                target = f"{folder}.deleted-{uuid.uuid4().hex[:8]}"
+                try:
+                    os.rename(folder, target)
+                    trash.append(target)
+                except OSError as e:
+                    # например, на Windows при открытом файле
+                    print(f"Не удалось переименовать {folder}: {e}")
+                    trash.extend(entry.path for entry in os.scandir(folder))
+                    continue
+            os.makedirs(folder, exist_ok=True)
+
+        def remove():
+            for path in trash:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        print(f"Ошибка при удалении файла {path}: {e}")
+
+        threading.Thread(target=remove, name='uploads-clear', daemon=True).start()
+
+    def start(self, history=None, interval=CLEANUP_INTERVAL, delay=CLEANUP_DELAY):
+        # фоновая очистка; поток запускается один раз на процесс
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(history, interval, delay),
+                                            name='uploads-cleanup', daemon=True)
+            self._thread.start()
+
+    def _run(self, history, interval, delay):
+        if self._stop.wait(delay):
+            return
+        while True:
+            try:
+                report = self.cleanup(history)
+                if report['removed_files'] or report['recompressed']:
+                    print(f"Очистка загрузок: удалено файлов {report['removed_files']} "
+                          f"({report['removed_bytes'] / 1024 ** 2:.1f} МБ), пережато {report['recompressed']}")
+            except Exception as e:
+                print(f"Ошибка очистки папки загрузок: {e}")
+            if self._stop.wait(interval):
+                return
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,156 @@
+import numpy as np
+
+
+TILED_INFERENCE = False  # нарезать кадр на перекрывающиеся тайлы (для кадров высокого разрешения)
+TILE_SIZE = 640  # сторона тайла в пикселях исходного кадра
+TILE_OVERLAP = 0.2  # доля перекрытия соседних тайлов
+TILE_FULL_FRAME = True  # дополнительно прогонять весь кадр (крупные собаки не режутся тайлами)
+TILE_NMS_IOU = 0.5  # порог NMS при объединении рамок из разных тайлов
+TILE_BATCH_SIZE = 32  # максимум тайлов в одном прогоне модели
+
+
+def make_tiles(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # координаты тайлов (x1, y1, x2, y2); последний тайл в ряду прижат к краю кадра
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        step = max(1, int(tile_size * (1 - overlap)))
+        positions = list(range(0, length - tile_size, step))
+        positions.append(length - tile_size)
+        return positions
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in starts(height) for x in starts(width)]
+
+
+def predict_tiled(run_model, frames, confidence_threshold, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                  full_frame=TILE_FULL_FRAME, nms_iou=TILE_NMS_IOU, batch_size=TILE_BATCH_SIZE):
+    # Sliced inference: тайлы всех кадров прогоняются батчами через run_model(images, conf),
+    # рамки переводятся в координаты кадра и объединяются NMS по классам.
+    # Возвращает по одному ultralytics Results на кадр (для _parse_result и plot())
+    import torch
+    from torchvision.ops import batched_nms
+    from ultralytics.engine.results import Results
+
+    crops, owners = [], []
+    for i, frame in enumerate(frames):
+        tiles = make_tiles(frame.shape[1], frame.shape[0], tile_size, overlap)
+        for x1, y1, x2, y2 in tiles:
+            crops.append(np.ascontiguousarray(frame[y1:y2, x1:x2]))
+            owners.append((i, x1, y1))
+        if full_frame and len(tiles) > 1:
+            crops.append(frame)
+            owners.append((i, 0, 0))
+
+    results = []
+    for start in range(0, len(crops), batch_size):
+        results.extend(run_model(crops[start:start + batch_size], confidence_threshold))
+
+    parts = [[] for _ in frames]
+    for (i, dx, dy), result in zip(owners, results):
+        if result.boxes is None or not len(result.boxes):
+            continue
+        data = result.boxes.data[:, :6].cpu().clone()  # x1, y1, x2, y2, conf, cls
+        data[:, [0, 2]] += dx
+        data[:, [1, 3]] += dy
+        parts[i].append(data)
+
+    names = results[0].names if results else {}
+    merged = []
+    for i, frame in enumerate(frames):
+        data = torch.cat(parts[i]) if parts[i] else torch.zeros((0, 6))
+        if len(data):
+            # одна собака на стыке тайлов дает несколько рамок - оставляем самую уверенную
+            keep = batched_nms(data[:, :4], data[:, 4], data[:, 5].long(), nms_iou)
+            data = data[keep]
+        merged.append(Results(frame, path='', names=names, boxes=data))
+    return merged
+
+
+def _load_labels(label_path, width, height):
+    # разметка в формате YOLO: class cx cy w h (нормированные)
+    boxes = []
+    try:
+        with open(label_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 5:
+                    continue
+                cx, cy, w, h = (float(v) for v in parts[1:5])
+                boxes.append([(cx - w / 2) * width, (cy - h / 2) * height,
+                              (cx + w / 2) * width, (cy + h / 2) * height])
+    except OSError:
+        pass
+    return np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def benchmark(detector, images, labels_dir=None, match_iou=0.5, **tile_options):
+    # Сравнение обычного predict и нарезки на тайлы: задержка на кадр,
+    # число найденных собак и (если есть разметка) полнота
+    import os
+    import time
+
+    import cv2
+
+    from detections import iou_matrix
+    from metrics import summarize
+
+    frames = [(path, img) for path, img in ((p, cv2.imread(p)) for p in images) if img is not None]
+    if not frames:
+        raise ValueError("Нет изображений для бенчмарка")
+
+    rows = []
+    for mode in ('single', 'tiled'):
+        detector.tiled = mode == 'tiled'
+        detector.tile_options = tile_options
+        detector.predict(frames[0][1])  # прогрев
+
+        latencies, found, matched, expected = [], 0, 0, 0
+        for path, img in frames:
+            t0 = time.perf_counter()
+            detections, _ = detector.predict(img)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            found += len(detections)
+
+            if labels_dir:
+                truth = _load_labels(os.path.join(labels_dir, f"{os.path.splitext(os.path.basename(path))[0]}.txt"),
+                                     img.shape[1], img.shape[0])
+                predicted = detections.boxes
+                expected += len(truth)
+                for box in truth:
+                    if len(predicted) and iou_matrix(box, predicted).max() >= match_iou:
+                        matched += 1
+
+        summary = summarize(latencies)
+        rows.append({
+            'mode': mode,
+            'mean_ms': summary['mean'],
+            'p50_ms': summary['p50'],
+            'p99_ms': summary['p99'],
+            'detections': found,
+            'recall': round(matched / expected, 4) if expected else None,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from backends import list_images
+    from model import MODEL_PATH, MuzzleDetectorModel
+
+    parser = argparse.ArgumentParser(description="Задержка и полнота: весь кадр против нарезки на тайлы")
+    parser.add_argument('--images', required=True)
+    parser.add_argument('--labels', default=None, help="папка с разметкой YOLO (.txt) для расчета полноты")
+    parser.add_argument('--weights', default=MODEL_PATH)
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument('--overlap', type=float, default=TILE_OVERLAP)
+    parser.add_argument('--no-full-frame', action='store_true')
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    detector = MuzzleDetectorModel(args.weights, history_backend=None)
+    for row in benchmark(detector, list_images(args.images, args.limit), args.labels,
+                         tile_size=args.tile_size, overlap=args.overlap, full_frame=not args.no_full_frame):
+        print(f"{row['mode']:<7} mean {row['mean_ms']:>8} ms   p50 {row['p50_ms']:>8} ms   "
+              f"p99 {row['p99_ms']:>8} ms   собак {row['detections']:>5}   полнота {row['recall']}")
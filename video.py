@@ -0,0 +1,231 @@
+import time
+from collections import Counter
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from annotate import draw_detections
+from detections import iou_matrix
+
+
+VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
+VIDEO_SOURCE = 'video'  # источник в истории для загруженных видеофайлов (без параметра source)
+VIDEO_BATCH_SIZE = 8  # кадров в одном прогоне модели
+MIN_STRIDE = 1  # шаг выборки кадров при движении в кадре
+MAX_STRIDE = 15  # шаг выборки кадров для статичной сцены
+MOTION_THRESHOLD = 4.0  # средняя разница яркости между выбранными кадрами
+MOTION_SIZE = 64  # размер уменьшенного кадра для оценки движения
+STATS_INTERVAL = 10.0  # длина интервала статистики в секундах видео
+TRACK_IOU = 0.3  # минимальный IoU для продления трека
+TRACK_MAX_MISSED = 5  # сколько выбранных кадров трек может не находиться
+
+
+def iter_frames(source, min_stride=MIN_STRIDE, max_stride=MAX_STRIDE, motion_threshold=MOTION_THRESHOLD):
+    # Генератор кадров из файла, камеры (индекс) или потока (rtsp://...).
+    # Шаг выборки адаптивный: пока сцена статична, он удваивается до max_stride,
+    # при движении сбрасывается до min_stride. Пропущенные кадры только grab()-аются,
+    # без преобразования в BGR. В памяти одновременно держится один кадр
+    cap = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not cap.isOpened():
+        raise IOError(f"Не удалось открыть видео: {source}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+
+    try:
+        index = -1
+        skip = 0
+        stride = min_stride
+        previous = None
+        while True:
+            if not cap.grab():
+                break
+            index += 1
+            if skip > 0:
+                skip -= 1
+                continue
+
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+
+            small = cv2.cvtColor(cv2.resize(frame, (MOTION_SIZE, MOTION_SIZE)), cv2.COLOR_BGR2GRAY)
+            if previous is not None:
+                motion = float(cv2.absdiff(small, previous).mean())
+                stride = min_stride if motion >= motion_threshold else min(stride * 2, max_stride)
+            previous = small
+            skip = stride - 1
+
+            yield index, index / fps, frame
+    finally:
+        cap.release()
+
+
+class IouTracker:
+    # Простой трекер по перекрытию рамок: детекция продлевает трек с наибольшим IoU,
+    # иначе начинает новый. Трек, не найденный max_missed кадров подряд, удаляется,
+    # поэтому число хранимых треков ограничено числом собак в кадре
+
+    def __init__(self, iou_threshold=TRACK_IOU, max_missed=TRACK_MAX_MISSED, on_finished=None):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.on_finished = on_finished
+        self.tracks = {}
+        self.next_id = 1
+
+    def update(self, detections):
+        # возвращает id трека для каждой детекции
+        ids = list(self.tracks)
+        assigned = [None] * len(detections)
+        if ids and len(detections):
+            ious = iou_matrix(detections.boxes, [self.tracks[i]['bbox'] for i in ids])
+            # жадное сопоставление по убыванию IoU
+            for flat in np.argsort(-ious, axis=None):
+                d, t = np.unravel_index(flat, ious.shape)
+                if ious[d, t] < self.iou_threshold:
+                    break
+                if assigned[d] is None and ids[t] is not None:
+                    assigned[d] = ids[t]
+                    ids[t] = None
+
+        for i, (box, label, confidence, class_id) in enumerate(detections.rows()):
+            if assigned[i] is None:
+                assigned[i] = self.next_id
+                self.tracks[self.next_id] = {'labels': Counter(), 'confidence': 0.0}
+                self.next_id += 1
+            track = self.tracks[assigned[i]]
+            track['bbox'] = box
+            track['class_id'] = class_id
+            track['missed'] = 0
+            track['labels'][label] += 1
+            track['confidence'] = max(track['confidence'], confidence)
+
+        # треки, не найденные в этом кадре
+        for track_id in [i for i in ids if i is not None]:
+            self.tracks[track_id]['missed'] += 1
+            if self.tracks[track_id]['missed'] > self.max_missed:
+                self.finish(track_id)
+
+        return assigned
+
+    def finish(self, track_id):
+        if self.on_finished is not None:
+            self.on_finished(self.summary(track_id))
+        del self.tracks[track_id]
+
+    def finish_all(self):
+        for track_id in list(self.tracks):
+            self.finish(track_id)
+
+    def summary(self, track_id):
+        # итог по треку: метка - по большинству кадров
+        track = self.tracks[track_id]
+        return {
+            "bbox": track['bbox'],
+            "label": track['labels'].most_common(1)[0][0],
+            "confidence": track['confidence'],
+            "class_id": track['class_id'],
+            "track_id": track_id,
+        }
+
+
+class VideoProcessor:
+    # Пайплайн видео: выборка кадров -> батчи -> трекинг -> статистика по интервалам.
+    # Каждая собака (трек) считается один раз в интервале, а не в каждом кадре
+
+    def __init__(self, predict_batch, batch_size=VIDEO_BATCH_SIZE, interval=STATS_INTERVAL,
+                 on_interval=None, **frame_options):
+        self.predict_batch = predict_batch
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_interval = on_interval
+        self.frame_options = frame_options
+
+    def run(self, source):
+        totals = Counter()  # метки завершенных треков за все видео
+        tracker = IouTracker(on_finished=lambda track: totals.update([track['label']]))
+        interval = {'start': 0.0, 'tracks': {}}
+        counters = {'frames_processed': 0, 'intervals': 0}
+        preview = {'detections': [], 'frame': None, 'frame_detections': []}
+        started = time.perf_counter()
+
+        def flush(end):
+            counters['intervals'] += 1
+            if self.on_interval is not None:
+                self.on_interval(list(interval['tracks'].values()), interval['start'], end)
+            interval['start'] = end
+            interval['tracks'] = {}
+
+        def process(batch):
+            # разметка рисуется только для превью-кадра, в конце
+            outputs = self.predict_batch([frame for _, _, frame in batch], render=False)
+            for (index, position, frame), (detections, _) in zip(batch, outputs):
+                while position >= interval['start'] + self.interval:
+                    flush(interval['start'] + self.interval)
+                tracked = []
+                for track_id in tracker.update(detections):
+                    summary = tracker.summary(track_id)
+                    interval['tracks'][track_id] = summary
+                    tracked.append(summary)
+                # кадр с наибольшим числом собак сохраняем как превью
+                if preview['frame'] is None or len(tracked) > len(preview['detections']):
+                    preview.update(detections=tracked, frame=frame, frame_detections=detections)
+                counters['frames_processed'] += 1
+                counters['last_frame'] = index
+
+        batch = []
+        position = 0.0
+        for index, position, frame in iter_frames(source, **self.frame_options):
+            batch.append((index, position, frame))
+            if len(batch) >= self.batch_size:
+                process(batch)
+                batch = []
+        if batch:
+            process(batch)
+        if interval['tracks'] or counters['intervals'] == 0:
+            flush(max(position, interval['start']))
+        tracker.finish_all()
+
+        counters['elapsed_sec'] = round(time.perf_counter() - started, 2)
+        stats = {
+            "total_dogs": sum(totals.values()),
+            "with_muzzle": totals.get("with_muzzle", 0),
+            "without_muzzle": totals.get("without_muzzle", 0),
+        }
+        image = None
+        if preview['frame'] is not None:
+            image = draw_detections(preview['frame'], preview['frame_detections'])
+        return stats, preview['detections'], image, counters
+
+
+def process_video(detector, source, filename=None, predict_batch=None, history_source=None, **options):
+    # Обрабатывает видео и пишет в историю по записи на каждый интервал.
+    # history_source - источник в истории (по умолчанию - камера/поток source);
+    # для временного файла загрузки нужен постоянный идентификатор, иначе каждое видео - новый источник.
+    # Возвращает (итоговая статистика, детекции превью-кадра, превью-кадр, счетчики)
+    filename = filename or str(source)
+    history_source = history_source or str(source)
+
+    def on_interval(tracks, start, end):
+        detector.save_to_history(filename, tracks, None, source=history_source,
+                                 type="video", video_time=[round(start, 2), round(end, 2)])
+
+    processor = VideoProcessor(predict_batch or detector.predict_batch, on_interval=on_interval, **options)
+    return processor.run(source)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from model import MuzzleDetectorModel
+
+    parser = argparse.ArgumentParser(description="Детекция собак в видеофайле или потоке")
+    parser.add_argument('source', help="путь к файлу, индекс камеры или URL потока")
+    parser.add_argument('--interval', type=float, default=STATS_INTERVAL)
+    parser.add_argument('--batch-size', type=int, default=VIDEO_BATCH_SIZE)
+    parser.add_argument('--max-stride', type=int, default=MAX_STRIDE)
+    args = parser.parse_args()
+
+    detector = MuzzleDetectorModel()
+    stats, _, _, counters = process_video(detector, args.source, interval=args.interval,
+                                          batch_size=args.batch_size, max_stride=args.max_stride)
+    print(f"{datetime.now():%H:%M:%S} Собак: {stats}, кадры: {counters}")
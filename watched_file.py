@@ -0,0 +1,49 @@
+import json
+import time
+from pathlib import Path
+
+
+class WatchedJsonFile:
+    # JSON-файл настроек, который правят без перезапуска сервера (профили порогов, реестр моделей).
+    # reload() проверяет mtime не чаще reload_interval и перечитывает файл только при изменении;
+    # с ошибкой в файле остается прежнее содержимое. Не потокобезопасен - вызывать под блокировкой владельца
+
+    def __init__(self, path, reload_interval, label="файл", validate=None):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self.label = label
+        self._validate = validate
+        self._mtime = None
+        self._checked = None
+        self.data = None  # None - файла нет
+
+    def reload(self, force=False):
+        # True - содержимое изменилось (в том числе файл удален)
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < self.reload_interval:
+            return False
+        self._checked = now
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            if self._mtime is None:
+                return False
+            self.data, self._mtime = None, None
+            return True
+        if mtime == self._mtime:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if self._validate is not None:
+                self._validate(data)
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать {self.label} {self.path}: {e}")
+            return False
+        self.data, self._mtime = data, mtime
+        return True
+
+    def saved(self, data):
+        # файл только что записан этим процессом - перечитывать его не нужно
+        self.data = data
+        self._mtime = self.path.stat().st_mtime_ns